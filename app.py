@@ -1,37 +1,114 @@
 import os
+import sys
 import json
 import time
 import uuid
+import random
+import hashlib
+import asyncio
 import logging
-import requests
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
 
+from typing import NamedTuple
 from datetime import datetime, timedelta
 from collections import defaultdict
+import httpx
+import numpy as np
+from cachetools import TTLCache, LRUCache
 
-from fastapi import FastAPI, Query, Body, HTTPException
-from fastapi.responses import RedirectResponse, PlainTextResponse
+from fastapi import FastAPI, Query, Body, Header, HTTPException
+from fastapi.responses import Response, ORJSONResponse, RedirectResponse, PlainTextResponse, JSONResponse
 
 from google.cloud import firestore
 from google.oauth2 import service_account
 
+import ranking
+import periods
+import metering
+import geometry
+from ranking import AGG_FIELDS
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:                                  # sin brotli: solo gzip
+    BrotliMiddleware = None
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.datastructures import MutableHeaders
+
 # ——— Configuración de logging —————————————————————————
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(levelname)s %(message)s")
 log = logging.getLogger("jogr-backend")
 
 # ——— Init FastAPI ——————————————————————————————————————
-app = FastAPI()
+# orjson por defecto; las rutas de payload grande devuelven ORJSONResponse
+# directamente para saltarse también jsonable_encoder (ya son dicts JSON nativos)
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# ——— Compresión de respuestas ————————————————————————————————
+# brotli si el cliente lo acepta (y está instalado), si no gzip; por debajo
+# del umbral no compensa
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESS_MIN_SIZE, gzip_fallback=True)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE)
+
+# ——— Contabilidad por petición ——————————————————————————————
+# Cada petición lleva en `metering.current` sus lecturas, escrituras y queries de
+# Firestore y sus llamadas a Strava. Se devuelven en Server-Timing, se
+# registran como campos del log y se avisa si una ruta pasa de READ_BUDGET
+# lecturas (0 = sin aviso). Los listeners y los comandos no cuentan.
+READ_BUDGET = int(os.getenv("READ_BUDGET", "300"))
+
+class RequestUsageMiddleware:
+    """ASGI puro (sin BaseHTTPMiddleware): abre el contador de la petición,
+    añade Server-Timing al empezar la respuesta y registra el total al
+    terminar, con aviso si se pasa del presupuesto de lecturas."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        usage, t0 = metering.Usage(), time.perf_counter()
+        token = metering.current.set(usage)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                ms = (time.perf_counter() - t0) * 1000
+                MutableHeaders(scope=message).append("Server-Timing", ", ".join(
+                    [f"app;dur={ms:.1f}", f'strava;desc="{usage.strava}"']
+                    + [f'fs-{k};desc="{getattr(usage, k)}"' for k in ("reads", "writes", "queries")]))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            metering.current.reset(token)
+            route = getattr(scope.get("route"), "path", scope["path"])
+            fields = {"route": route, "method": scope["method"], **usage.fields(),
+                      "ms": round((time.perf_counter() - t0) * 1000, 1)}
+            log.info("📏 %s %s reads=%d writes=%d queries=%d strava=%d %.1fms", scope["method"], route,
+                     usage.reads, usage.writes, usage.queries, usage.strava, fields["ms"],
+                     extra={"usage": fields})
+            if READ_BUDGET and usage.reads > READ_BUDGET:
+                log.warning("⚠️ %s %s superó el presupuesto de lecturas: %d > %d",
+                            scope["method"], route, usage.reads, READ_BUDGET, extra={"usage": fields})
+
+# el último en añadirse es el más externo: cuenta también la compresión
+app.add_middleware(RequestUsageMiddleware)
 
 # ——— Firestore ————————————————————————————————————————
 cred_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
 if not cred_json:
     raise RuntimeError("Falta GOOGLE_CREDENTIALS_JSON")
 
-db = firestore.Client(
-    credentials=service_account.Credentials.from_service_account_info(
-        json.loads(cred_json)
-    )
-)
+credentials = service_account.Credentials.from_service_account_info(json.loads(cred_json))
+db = metering.MeteredAsyncClient(credentials=credentials)
 log.info("✅ Firestore conectado")
 
 # ——— Strava constants ————————————————————————————————————
@@ -39,34 +116,276 @@ CLIENT_ID             = os.getenv("CLIENT_ID", "")
 CLIENT_SECRET         = os.getenv("CLIENT_SECRET", "")
 STRAVA_TOKEN_URL      = "https://www.strava.com/oauth/token"
 STRAVA_ACTIVITIES_URL = "https://www.strava.com/api/v3/athlete/activities"
+STRAVA_ACTIVITY_URL   = "https://www.strava.com/api/v3/activities/{id}"
 
 CALLBACK_PATH  = "/auth/strava/callback"
 BACKEND_ORIGIN = os.getenv("BACKEND_ORIGIN", "https://jogr-backend.onrender.com")
 REDIRECT_URI   = f"{BACKEND_ORIGIN}{CALLBACK_PATH}"
 
-# ——— Helpers Firestore ————————————————————————————————————
-def oauth_doc(uid: str):
-    return db.collection("users").document(uid).collection("oauth").document("strava")
+WEBHOOK_PATH         = "/webhooks/strava"
+STRAVA_VERIFY_TOKEN  = os.getenv("STRAVA_VERIFY_TOKEN", "")
+STRAVA_SUBSCRIPTION  = os.getenv("STRAVA_SUBSCRIPTION_ID", "")    # id que devolvió Strava al suscribirse
+WEBHOOK_WORKERS      = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE   = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
 
-def ensure_access_token(uid: str) -> str:
-    doc = oauth_doc(uid).get()
-    if not doc.exists:
-        raise HTTPException(404, "Token Strava no encontrado")
-    data = doc.to_dict()
-    if time.time() > data["expires_at"] - 300:
-        log.info("🔄 Refrescando token Strava para %s", uid)
-        r = requests.post(STRAVA_TOKEN_URL, data={
+STRAVA_POOL_SIZE       = int(os.getenv("STRAVA_POOL_SIZE", "20"))
+STRAVA_RETRIES         = int(os.getenv("STRAVA_RETRIES", "3"))
+STRAVA_BACKOFF         = float(os.getenv("STRAVA_BACKOFF", "0.5"))
+STRAVA_CONNECT_TIMEOUT = float(os.getenv("STRAVA_CONNECT_TIMEOUT", "3.05"))
+STRAVA_READ_TIMEOUT    = float(os.getenv("STRAVA_READ_TIMEOUT", "15"))
+
+STRAVA_LIMIT_15MIN = int(os.getenv("STRAVA_LIMIT_15MIN", "200"))
+STRAVA_LIMIT_DAILY = int(os.getenv("STRAVA_LIMIT_DAILY", "2000"))
+STRAVA_RESERVE     = int(os.getenv("STRAVA_RESERVE", "20"))     # reservado a llamadas urgentes
+
+# ——— Governor de rate limit Strava ———————————————————————————————
+class StravaBudgetExhausted(Exception):
+    """No queda presupuesto de Strava para esta llamada."""
+    def __init__(self, retry_after: int):
+        super().__init__(f"Presupuesto Strava agotado, reintentar en {retry_after}s")
+        self.retry_after = retry_after
+
+class StravaGovernor:
+    """Token bucket global sobre los límites de app de Strava (ventana de
+    15 min y diaria). Cada respuesta recalibra el uso real con las cabeceras
+    X-RateLimit-Limit/X-RateLimit-Usage; antes de cada llamada `admit`
+    consume un token. Las llamadas no urgentes dejan `reserve` tokens libres
+    para refrescos de token y logins."""
+
+    WINDOWS = (900, 86400)
+
+    def __init__(self,
+                 limit_15min: int = STRAVA_LIMIT_15MIN,
+                 limit_daily: int = STRAVA_LIMIT_DAILY,
+                 reserve: int = STRAVA_RESERVE):
+        self.lock     = threading.Lock()
+        self.reserve  = reserve
+        self.limit    = [limit_15min, limit_daily]
+        self.usage    = [0, 0]
+        self.window   = self._windows()
+        self.admitted = 0
+        self.rejected = 0
+
+    def _windows(self) -> tuple:
+        now = time.time()
+        return tuple(int(now // w) for w in self.WINDOWS)
+
+    def _roll(self):
+        current = self._windows()
+        for i, w in enumerate(current):
+            if w != self.window[i]:
+                self.usage[i] = 0
+        self.window = current
+
+    def _remaining(self) -> int:
+        return min(l - u for l, u in zip(self.limit, self.usage))
+
+    def retry_after(self) -> int:
+        """Segundos hasta que se reabra la ventana que está agotada."""
+        now = time.time()
+        with self.lock:
+            i = 1 if self.limit[1] - self.usage[1] <= 0 else 0
+        w = self.WINDOWS[i]
+        return int(w - now % w) + 1
+
+    def admit(self, urgent: bool = False):
+        with self.lock:
+            self._roll()
+            if self._remaining() <= (0 if urgent else self.reserve):
+                self.rejected += 1
+                exhausted = True
+            else:
+                self.usage = [u + 1 for u in self.usage]
+                self.admitted += 1
+                exhausted = False
+        if exhausted:
+            raise StravaBudgetExhausted(self.retry_after())
+
+    def observe(self, headers, status: int):
+        limit = headers.get("X-RateLimit-Limit")
+        usage = headers.get("X-RateLimit-Usage")
+        with self.lock:
+            self._roll()
+            if limit and usage:
+                self.limit = [int(x) for x in limit.split(",")[:2]]
+                self.usage = [int(x) for x in usage.split(",")[:2]]
+            if status == 429:
+                # la ventana corta está agotada hasta el próximo cuarto de hora
+                self.usage[0] = max(self.usage[0], self.limit[0])
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            self._roll()
+            return {
+                "limit15min":     self.limit[0],
+                "usage15min":     self.usage[0],
+                "limitDaily":     self.limit[1],
+                "usageDaily":     self.usage[1],
+                "remaining":      self._remaining(),
+                "reserve":        self.reserve,
+                "admitted":       self.admitted,
+                "rejected":       self.rejected,
+            }
+
+governor = StravaGovernor()
+
+# ——— Cliente HTTP Strava ——————————————————————————————————————
+class StravaClient:
+    """Cliente httpx asíncrono compartido contra www.strava.com: pool de
+    conexiones keep-alive, reintentos con backoff en 5xx y errores de
+    transporte, y timeouts de conexión y lectura, para no pagar un handshake
+    TCP+TLS en cada llamada. Los 429 no se reintentan: los gestiona el
+    governor."""
+
+    RETRY_STATUS = (500, 502, 503, 504)
+
+    def __init__(self,
+                 pool_size: int = STRAVA_POOL_SIZE,
+                 retries: int = STRAVA_RETRIES,
+                 backoff: float = STRAVA_BACKOFF,
+                 timeout: tuple = (STRAVA_CONNECT_TIMEOUT, STRAVA_READ_TIMEOUT)):
+        self.retries = retries
+        self.backoff = backoff
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size,
+                                max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+
+    async def request(self, method: str, url: str, urgent: bool = False, **kw) -> httpx.Response:
+        governor.admit(urgent)
+        for attempt in range(self.retries + 1):
+            metering.meter(strava=1)
+            try:
+                r = await self.http.request(method, url, **kw)
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+            else:
+                governor.observe(r.headers, r.status_code)
+                if r.status_code not in self.RETRY_STATUS or attempt == self.retries:
+                    break
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+        if r.status_code == 429:
+            raise StravaBudgetExhausted(governor.retry_after())
+        r.raise_for_status()
+        return r
+
+    async def token(self, **data) -> dict:
+        """POST a /oauth/token con las credenciales de la app (siempre urgente)."""
+        r = await self.request("POST", STRAVA_TOKEN_URL, urgent=True, data={
             "client_id":     CLIENT_ID,
             "client_secret": CLIENT_SECRET,
-            "grant_type":    "refresh_token",
-            "refresh_token": data["refresh_token"]
+            **data
         })
-        r.raise_for_status()
-        fresh = r.json()
-        fresh["expires_at"] = time.time() + fresh["expires_in"]
-        oauth_doc(uid).set(fresh)
-        return fresh["access_token"]
-    return data["access_token"]
+        return r.json()
+
+    async def activities(self, token: str, **params) -> list:
+        r = await self.request("GET", STRAVA_ACTIVITIES_URL,
+                               headers={"Authorization": f"Bearer {token}"},
+                               params=params)
+        return r.json()
+
+    async def activity(self, token: str, act_id) -> dict:
+        r = await self.request("GET", STRAVA_ACTIVITY_URL.format(id=act_id),
+                               headers={"Authorization": f"Bearer {token}"})
+        return r.json()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+strava = StravaClient()
+
+# ——— Concurrencia de lecturas sociales ———————————————————————
+SOCIAL_WORKERS = int(os.getenv("SOCIAL_WORKERS", "16"))     # count() en vuelo por petición
+
+# ——— Likes: layout por usuario y contador sharded ——————————————————
+LIKE_SHARDS           = int(os.getenv("LIKE_SHARDS", "10"))
+# a partir de aquí los likes pasan a likes/{uid} (cabe en un commit de 500)
+LIKES_SHARD_THRESHOLD = min(int(os.getenv("LIKES_SHARD_THRESHOLD", "200")), 400)
+
+# ——— Caché de nicknames ——————————————————————————————————————
+NICK_CACHE_TTL  = int(os.getenv("NICK_CACHE_TTL", "600"))
+NICK_CACHE_SIZE = int(os.getenv("NICK_CACHE_SIZE", "10000"))
+nick_cache      = TTLCache(maxsize=NICK_CACHE_SIZE, ttl=NICK_CACHE_TTL)
+
+# ——— Helpers Firestore ————————————————————————————————————
+async def _get_all(refs: list, **kw) -> list:
+    """db.get_all materializado en lista (vacía sin refs, sin RPC)."""
+    if not refs:
+        return []
+    return [snap async for snap in db.get_all(refs, **kw)]
+
+async def resolve_nicknames(uids) -> dict:
+    """Devuelve {uid: nickname}. Lo que no está en la caché TTL/LRU del
+    proceso se resuelve con un único get_all limitado al campo nickname."""
+    uids = set(uids)
+    out = {u: nick_cache[u] for u in uids if u in nick_cache}
+    missing = uids - out.keys()
+    if missing:
+        refs  = [db.collection("users").document(u) for u in missing]
+        fresh = {u: "Usuario" for u in missing}
+        for snap in await _get_all(refs, field_paths=["nickname"]):
+            if snap.exists:
+                fresh[snap.id] = snap.to_dict().get("nickname", "Usuario")
+        nick_cache.update(fresh)
+        out.update(fresh)
+    return out
+
+def oauth_doc(uid: str):
+    return db.collection("users").document(uid).collection("oauth").document("strava")
+
+# ——— Caché de tokens Strava (single-flight) ——————————————————————
+# uid -> doc oauth/strava; un fallo solo cuesta releerlo de Firestore
+token_cache = TTLCache(maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")),
+                       ttl=int(os.getenv("TOKEN_CACHE_TTL", "3600")))
+token_locks = {}    # uid -> [asyncio.Lock, peticiones que lo usan]: un solo refresh por usuario
+
+@asynccontextmanager
+async def _token_lock(uid: str):
+    """Lock del refresh de `uid`; se borra cuando ya nadie lo tiene ni lo espera."""
+    entry = token_locks.setdefault(uid, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del token_locks[uid]
+
+def _token_valid(data: dict) -> bool:
+    return time.time() <= data["expires_at"] - 300
+
+async def ensure_access_token(uid: str) -> str:
+    data = token_cache.get(uid)
+    if data and _token_valid(data):
+        return data["access_token"]
+
+    async with _token_lock(uid):
+        # otra petición pudo refrescarlo mientras esperábamos el lock
+        data = token_cache.get(uid)
+        if data and _token_valid(data):
+            return data["access_token"]
+
+        doc = await oauth_doc(uid).get()
+        if not doc.exists:
+            raise HTTPException(404, "Token Strava no encontrado")
+        data = doc.to_dict()
+        if not _token_valid(data):
+            log.info("🔄 Refrescando token Strava para %s", uid)
+            data = await strava.token(grant_type="refresh_token",
+                                      refresh_token=data["refresh_token"])
+            data["expires_at"] = time.time() + data["expires_in"]
+            await oauth_doc(uid).set(data)
+        token_cache[uid] = data
+        return data["access_token"]
+
+# ——— Fechas: timestamps nativos de Firestore ——————————————————————
+def _iso(v) -> str:
+    """Timestamp -> ISO con Z, el formato que siempre ha recibido la app."""
+    if isinstance(v, datetime):
+        return periods.to_ts(v).isoformat().replace("+00:00", "Z")
+    return v
 
 # ——— Normalizador de actividades —————————————————————————
 
@@ -80,7 +399,7 @@ def _fmt_act(d: dict) -> dict:
         "distance":  d["distance"],
         "duration":  d["duration"],
         "elevation": d["elevation"],
-        "date":      d["date"],
+        "date":      _iso(d["date"]),
         "includedInLeagues": d.get("includedInLeagues", []),
         # sociales por defecto
         "likeCount":    d.get("likeCount", 0),
@@ -88,42 +407,353 @@ def _fmt_act(d: dict) -> dict:
         "commentCount": d.get("commentCount", 0)
     }
     if "avg_speed"        in d: out["avg_speed"]        = d["avg_speed"]
-    if "summary_polyline" in d: out["summary_polyline"] = d["summary_polyline"]
+    if "summary_polyline" in d:
+        out["summary_polyline"] = d["summary_polyline"]
+        if "polyline_simplified" in d:
+            # la simplificada guardada al salvar evita recalcularla en polyline=simplified
+            simplified_cache[(out["id"], hash(d["summary_polyline"]))] = d["polyline_simplified"]
+    return out
+
+# ——— Polylines: none | simplified | full —————————————————————————
+POLYLINE_MODES     = ("none", "simplified", "full")
+POLYLINE_THUMB_PX  = int(os.getenv("POLYLINE_THUMB_PX", "200"))     # lado de la miniatura
+simplified_cache   = LRUCache(maxsize=int(os.getenv("POLYLINE_CACHE_SIZE", "20000")))
+
+async def _simplified(items: list) -> list:
+    """Polylines simplificadas de [(id, polyline)]; "" si la polyline está mal
+    formada (se guarda igual, ver `_route_fields`). Los fallos de caché se
+    simplifican en un solo lote fuera del bucle de eventos."""
+    # la clave lleva el hash de la polyline: un re-guardado con otra ruta no
+    # sirve la simplificación vieja
+    keys = [(act_id, hash(poly)) for act_id, poly in items]
+    out  = {k: simplified_cache[k] for k in keys if k in simplified_cache}
+    miss = {k: poly for k, (_, poly) in zip(keys, items) if k not in out}
+    if miss:
+        done = await asyncio.to_thread(geometry.simplify_polylines, list(miss.values()), POLYLINE_THUMB_PX)
+        for k, poly in zip(miss, done):
+            out[k] = simplified_cache[k] = poly or ""
+    return [out[k] for k in keys]
+
+def _route_fields(poly: str) -> dict:
+    """Inicio, fin, bbox y polyline simplificada de una ruta, para guardarlos
+    en la actividad. Vacío (y el guardado sigue) si la polyline no decodifica."""
+    summary = geometry.route_summaries([poly], POLYLINE_THUMB_PX)[0]
+    if summary is None and poly:
+        log.warning("⚠️ summary_polyline no decodificable, se guarda sin geometría")
+    return summary or {}
+
+def _check_polyline(mode: str) -> str:
+    mode = mode.lower()
+    if mode not in POLYLINE_MODES:
+        raise HTTPException(400, "polyline debe ser none, simplified o full")
+    return mode
+
+async def _with_polyline(acts: list, mode: str) -> list:
+    """Aplica el modo de polyline a actividades ya formateadas, sin tocar
+    las originales (pueden venir de la caché de feeds). Una polyline que no
+    se puede simplificar se omite."""
+    if mode == "full":
+        return acts
+    out = [dict(e) if e.get("summary_polyline") else e for e in acts]
+    with_poly = [e for e in out if e.get("summary_polyline")]
+    if mode == "none":
+        for e in with_poly:
+            del e["summary_polyline"]
+        return out
+    simplified = await _simplified([(e["id"], e["summary_polyline"]) for e in with_poly])
+    for e, poly in zip(with_poly, simplified):
+        if poly:
+            e["summary_polyline"] = poly
+        else:
+            del e["summary_polyline"]
     return out
 
+# ——— Hidratación social por lotes ————————————————————————
+
+def _likes_ref(act_id: str):
+    return db.collection("activities").document(act_id)\
+             .collection("social").document("likes")
+
+def _member_ref(act_id: str, uid: str):
+    return db.collection("activities").document(act_id).collection("likes").document(uid)
+
+def _shard_refs(act_id: str) -> list:
+    shards = db.collection("activities").document(act_id).collection("like_shards")
+    return [shards.document(str(i)) for i in range(LIKE_SHARDS)]
+
+async def _sharded_like_counts(act_ids) -> dict:
+    """Suma los like_shards de cada actividad con un único get_all."""
+    counts = {a: 0 for a in act_ids}
+    for snap in await _get_all([r for a in act_ids for r in _shard_refs(a)]):
+        if snap.exists:
+            counts[snap.reference.parent.parent.id] += snap.get("count") or 0
+    return counts
+
+async def _comment_count(act_id: str) -> int:
+    agg = await db.collection("activities").document(act_id)\
+                  .collection("comments").count().get()
+    return int(agg[0][0].value)
+
+async def _comment_counts(act_ids: list) -> dict:
+    """count() de comentarios concurrentes, como mucho SOCIAL_WORKERS a la vez."""
+    sem = asyncio.Semaphore(SOCIAL_WORKERS)
+
+    async def one(a):
+        async with sem:
+            return await _comment_count(a)
+
+    return dict(zip(act_ids, await asyncio.gather(*(one(a) for a in act_ids))))
+
+class FeedView(NamedTuple):
+    """Feed formateado de una liga, independiente de quién lo pide: didILike
+    se aplica encima con `likers` (layout plano) o leyendo en vivo los
+    shards y likes/{uid} de las actividades `sharded`. `ids` son los ids de
+    doc, en el orden de `activities`. `version` es la de la liga leída antes
+    de la query: la vista refleja al menos ese estado."""
+    ids:        list
+    activities: list
+    likers:     dict
+    sharded:    frozenset
+    version:    object = None
+
+async def _build_feed(acts: dict, version=None) -> FeedView:
+    """Recibe {act_id: doc} y formatea el feed con sus contadores.
+
+    Los contadores salen del propio doc (likeCount/commentCount
+    desnormalizados). Los docs de likes de las actividades no sharded se leen
+    en un único get_all para conocer quién ha dado like; solo se lanzan
+    count() de comentarios, en paralelo, para docs sin commentCount."""
+    plain = [a for a, d in acts.items() if not d.get("likesSharded")]
+    need_comments = [a for a, d in acts.items() if "commentCount" not in d]
+    snaps, counts = await asyncio.gather(_get_all([_likes_ref(a) for a in plain]),
+                                         _comment_counts(need_comments))
+    likers = {a: frozenset() for a in plain}
+    for snap in snaps:
+        if snap.exists:
+            likers[snap.reference.parent.parent.id] = frozenset(snap.to_dict().get("users", []))
+
+    activities = []
+    for a, d in acts.items():
+        entry = _fmt_act(d)
+        entry["didILike"] = False
+        if a in likers and "likeCount" not in d:
+            entry["likeCount"] = len(likers[a])
+        if "commentCount" not in d:
+            entry["commentCount"] = counts[a]
+        activities.append(entry)
+    return FeedView(list(acts), activities, likers,
+                    frozenset(a for a, d in acts.items() if d.get("likesSharded")), version)
+
+async def _overlay_feed(view: FeedView, user_id: str = None) -> list:
+    """Feed de `view` para `user_id`: didILike desde los likers cacheados y,
+    en las sharded, contador y didILike leídos en vivo en un único get_all
+    (sus likes no tocan las copias de liga, así que no invalidan la caché).
+    Las entradas sin cambios se comparten con la vista."""
+    if not user_id and not view.sharded:
+        return view.activities
+    refs = [r for a in view.sharded for r in _shard_refs(a)]
+    if user_id:
+        refs += [_member_ref(a, user_id) for a in view.sharded]
+    counts, liked = defaultdict(int), set()
+    for snap in await _get_all(refs):
+        if not snap.exists:
+            continue
+        act_id = snap.reference.parent.parent.id
+        if snap.reference.parent.id == "likes":
+            liked.add(act_id)
+        else:
+            counts[act_id] += snap.get("count") or 0
+
+    out = []
+    for a, e in zip(view.ids, view.activities):
+        if a in view.sharded:
+            out.append({**e, "likeCount": counts[a], "didILike": a in liked})
+        elif user_id in view.likers[a]:
+            out.append({**e, "didILike": True})
+        else:
+            out.append(e)
+    return out
+
+# ——— Contadores sociales desnormalizados ——————————————————————
+
+def _copy_refs(snap) -> list:
+    """Copias de activities/{act} en cada liga de su includedInLeagues, sin
+    repetir ligas. Vacío si la actividad no existe."""
+    if not snap.exists:
+        return []
+    return [db.collection("leagues").document(lg).collection("activities").document(snap.id)
+            for lg in dict.fromkeys(snap.to_dict().get("includedInLeagues", []))]
+
+async def _counter_refs(transaction, snap) -> list:
+    """Refs que llevan likeCount/commentCount: activities/{act} y las copias
+    de liga que existen (un update sobre una copia que falta tumbaría la
+    transacción con NotFound). Lee antes de que la transacción escriba."""
+    if not snap.exists:
+        return []
+    copies = _copy_refs(snap)
+    found  = {s.reference.path for s in await _get_all(copies, transaction=transaction) if s.exists}
+    return [snap.reference] + [r for r in copies if r.path in found]
+
+async def _activity_snap(transaction, act: str):
+    return await db.collection("activities").document(act).get(transaction=transaction)
+
+def _bump(transaction, refs: list, field: str, delta: int):
+    for r in refs:
+        transaction.update(r, {field: firestore.Increment(delta)})
+
+# ——— Versiones para ETags ————————————————————————————————————
+# La versión de una liga y la de las actividades de un usuario suben con cada
+# escritura que cambia lo que devuelven los endpoints de lectura (guardado,
+# likes, comentarios, reglas); el ETag se deriva de ellas sin montar la
+# respuesta. Cada like de una actividad popular las sube, así que son
+# contadores sharded (Firestore aguanta ~1 escritura/s por doc): shards en
+# leagues/{lid}/version_shards y users/{uid}/activitiesVersion_shards, más
+# el campo heredado del doc (ya no se incrementa, evita repetir versiones
+# antiguas). No reducir VERSION_SHARDS: se dejarían de sumar shards.
+VERSION_SHARDS = int(os.getenv("VERSION_SHARDS", "8"))
+
+def _version_shards(ref, field: str) -> list:
+    return [ref.collection(f"{field}_shards").document(str(i)) for i in range(VERSION_SHARDS)]
+
+def _bump_version(writer, ref, field: str):
+    """Escritura ciega (sin lectura previa) en un shard al azar: no añade
+    contención. `writer` es una transacción o un batch."""
+    writer.set(ref.collection(f"{field}_shards").document(str(random.randrange(VERSION_SHARDS))),
+               {"count": firestore.Increment(1)}, merge=True)
+
+async def _read_version(ref, field: str, fields=()) -> tuple:
+    """(versión, dict del doc con `fields`) en un solo get_all: el campo
+    heredado más la suma de los shards."""
+    snaps = {s.reference.path: s for s in await _get_all([ref] + _version_shards(ref, field),
+                                                        field_paths=[field, "count", *fields])}
+    doc = snaps.pop(ref.path).to_dict() or {}
+    return doc.get(field, 0) + sum((s.to_dict() or {}).get("count", 0) for s in snaps.values() if s.exists), doc
+
+def _bump_versions(transaction, leagues=(), uid: str = None):
+    for lid in leagues:
+        _bump_version(transaction, db.collection("leagues").document(lid), "version")
+    if uid:
+        _bump_version(transaction, db.collection("users").document(uid), "activitiesVersion")
+
+def _bump_activity_versions(transaction, snap):
+    """Versiones que cambian al tocar lo social de la actividad de `snap`:
+    sus ligas y las actividades de su autor."""
+    if snap.exists:
+        d = snap.to_dict()
+        _bump_versions(transaction, dict.fromkeys(d.get("includedInLeagues", [])), d.get("userID"))
+
+def _etag(*parts) -> str:
+    return '"%s"' % hashlib.sha1(repr(parts).encode()).hexdigest()[:27]
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def _etag_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=_etag_headers(etag))
+
+async def backfill_counters():
+    """Comando one-off: rellena likeCount/commentCount en activities/{id} y
+    sus copias de liga a partir de los datos sociales existentes."""
+    batch, ops, n = db.batch(), 0, 0
+    async for d in db.collection("activities").stream():
+        likes = await _likes_ref(d.id).get()
+        likes = likes.to_dict() if likes.exists else {}
+        counters = {
+            "likeCount":    (await _sharded_like_counts([d.id]))[d.id] if likes.get("sharded")
+                            else len(likes.get("users", [])),
+            "commentCount": await _comment_count(d.id),
+        }
+        # set con merge crearía copias sueltas en ligas donde falta la copia
+        refs = [d.reference] + [c.reference for c in await _get_all(_copy_refs(d)) if c.exists]
+        for r in refs:
+            batch.set(r, counters, merge=True)
+            ops += 1
+        n += 1
+        if ops >= 400:
+            await batch.commit()
+            batch, ops = db.batch(), 0
+    if ops:
+        await batch.commit()
+    log.info("🧮 Contadores sociales rellenados en %d actividades", n)
+
+ACT_REQUIRED = ("userID", "type", "distance", "duration", "elevation", "date")
+# campo del shape de la app -> campo almacenado en Firestore (None = calculado)
+ACT_FIELDS = {
+    "userID": "userID", "id": "activityID", "type": "type",
+    "distance": "distance", "duration": "duration", "elevation": "elevation",
+    "date": "date", "includedInLeagues": "includedInLeagues",
+    "likeCount": "likeCount", "didILike": None, "commentCount": "commentCount",
+    "avg_speed": "avg_speed", "summary_polyline": "summary_polyline",
+}
+
+def _project(d: dict, fields: list) -> dict:
+    """_fmt_act restringido a `fields` (más el id) sobre un doc leído con select()."""
+    out = _fmt_act({**dict.fromkeys(ACT_REQUIRED), **d})
+    return {k: out[k] for k in ["id", *fields] if k in out}
+
+def _fmt_strava(uid: str, a: dict) -> dict:
+    """Actividad cruda de la API de Strava -> shape de la app móvil."""
+    return {
+        "userID":           uid,
+        "id":               str(a["id"]),
+        "type":             a["type"],
+        "distance":         round(a["distance"] / 1000, 2),
+        "duration":         round(a["moving_time"] / 60, 2),
+        "elevation":        round(a["total_elevation_gain"], 2),
+        "avg_speed":        a.get("average_speed"),
+        "summary_polyline": a["map"]["summary_polyline"],
+        "date":             a["start_date"],
+        "includedInLeagues": [],
+        "likeCount": 0,
+        "didILike": False,
+        "commentCount": 0
+    }
+
+def _epoch(iso: str) -> int:
+    return int(datetime.fromisoformat(iso.replace("Z", "+00:00")).timestamp())
+
 # ——— Health-check —————————————————————————————————————————
 @app.get("/")
-def health() -> PlainTextResponse:
+async def health() -> PlainTextResponse:
     return PlainTextResponse("OK", status_code=200)
 
+@app.get("/metrics/strava")
+async def strava_budget():
+    return governor.snapshot()
+
+@app.exception_handler(StravaBudgetExhausted)
+async def strava_budget_exhausted(_, exc: StravaBudgetExhausted):
+    return JSONResponse({"detail": str(exc)}, status_code=503,
+                        headers={"Retry-After": str(exc.retry_after)})
+
 # ——— Strava OAuth callback ——————————————————————————————
 @app.get(CALLBACK_PATH)
-def strava_callback(
+async def strava_callback(
     code:  str = Query(..., description="Código de autorización de Strava"),
     state: str = Query(None, description="State opcional")
 ):
     log.info("🔑 Callback Strava recibido: code=%s state=%s", code, state)
 
     # 1) Intercambio del code por tokens
-    r = requests.post(STRAVA_TOKEN_URL, data={
-        "client_id":     CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "code":          code,
-        "grant_type":    "authorization_code",
-        "redirect_uri":  REDIRECT_URI
-    })
-    r.raise_for_status()
-    tok = r.json()
+    tok = await strava.token(code=code,
+                             grant_type="authorization_code",
+                             redirect_uri=REDIRECT_URI)
     log.info("✅ Token Strava OK: athlete.id=%s", tok["athlete"]["id"])
 
     # 2) Usuario en Firestore (o crear si es nuevo)
     sid  = str(tok["athlete"]["id"])
     nick = tok["athlete"].get("username") or tok["athlete"].get("firstname") or "strava"
-    q    = db.collection("users").where("stravaID", "==", sid).get()
+    q    = await db.collection("users").where("stravaID", "==", sid).get()
     uid  = q[0].id if q else str(uuid.uuid4())
 
     if not q:
-        db.collection("users").document(uid).set({
+        await db.collection("users").document(uid).set({
             "userID":    uid,
             "stravaID":  sid,
             "nickname":  nick,
@@ -138,181 +768,1030 @@ def strava_callback(
 
     # 3) Guardar tokens con expires_at
     tok["expires_at"] = time.time() + tok["expires_in"]
-    oauth_doc(uid).set(tok)
+    await oauth_doc(uid).set(tok)
+    token_cache[uid] = tok
     log.info("💾 Tokens guardados para userID=%s", uid)
 
     # 4) Redirige a la app móvil
     return RedirectResponse(f"jogr://auth?userID={uid}&code={code}", status_code=302)
 
+# ——— Strava webhooks (push) ————————————————————————————————
+webhook_queue = None                                  # asyncio.Queue, se crea en startup
+athlete_uids  = TTLCache(maxsize=10000, ttl=3600)     # stravaID -> userID
+
+async def _uid_for_athlete(sid: str):
+    if sid in athlete_uids:
+        return athlete_uids[sid]
+    q = await db.collection("users").where("stravaID", "==", sid).limit(1).get()
+    uid = q[0].id if q else None
+    if uid:
+        athlete_uids[sid] = uid
+    return uid
+
+async def _handle_strava_event(ev: dict):
+    """Procesa un evento del webhook: solo pide a Strava la actividad que
+    cambió y la guarda con el mismo shape que strava_activities."""
+    uid = await _uid_for_athlete(str(ev["owner_id"]))
+    if not uid:
+        log.info("🪝 Evento Strava de atleta desconocido %s", ev["owner_id"])
+        return
+
+    if ev["object_type"] == "athlete":
+        if str(ev.get("updates", {}).get("authorized", "")).lower() == "false":
+            await oauth_doc(uid).delete()
+            token_cache.pop(uid, None)
+            log.info("🚫 Strava desautorizado para %s", uid)
+        return
+
+    act_id = str(ev["object_id"])
+    if ev["aspect_type"] == "delete":
+        await _push_strava(uid, removed=act_id)
+        return
+
+    a = await strava.activity(await ensure_access_token(uid), act_id)
+    if a["type"] in ("Run", "Walk"):
+        await _push_strava(uid, item=_fmt_strava(uid, a))
+    else:
+        await _push_strava(uid, removed=act_id)
+    log.info("🪝 Actividad %s (%s) sincronizada para %s", act_id, ev["aspect_type"], uid)
+
+def _requeue_event(ev: dict):
+    try:
+        webhook_queue.put_nowait(ev)
+    except asyncio.QueueFull:
+        log.warning("⚠️ Evento Strava %s descartado: cola llena", ev["object_id"])
+
+async def _webhook_worker():
+    while True:
+        ev = await webhook_queue.get()
+        try:
+            await _handle_strava_event(ev)
+        except StravaBudgetExhausted as e:
+            # sync no urgente: se aplaza hasta que se reabra la ventana
+            log.info("⏳ Evento Strava %s aplazado %ds", ev["object_id"], e.retry_after)
+            asyncio.get_running_loop().call_later(e.retry_after, _requeue_event, ev)
+        except Exception:
+            log.exception("❌ Error procesando evento Strava %s", ev)
+        finally:
+            webhook_queue.task_done()
+
+webhook_tasks = []
+
+@app.on_event("startup")
+async def start_webhook_workers():
+    global webhook_queue
+    webhook_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    webhook_tasks.extend(asyncio.create_task(_webhook_worker(), name=f"strava-webhook-{i}")
+                         for i in range(WEBHOOK_WORKERS))
+
+@app.on_event("shutdown")
+async def shutdown():
+    for t in webhook_tasks:
+        t.cancel()
+    await asyncio.gather(*(asyncio.to_thread(f.watch.unsubscribe) for f in feed_cache.values()))
+    await strava.aclose()
+
+@app.get(WEBHOOK_PATH)
+async def strava_webhook_challenge(
+    mode:      str = Query(..., alias="hub.mode"),
+    challenge: str = Query(..., alias="hub.challenge"),
+    token:     str = Query(..., alias="hub.verify_token")
+):
+    # sin token configurado se rechaza todo: un token vacío no verifica nada
+    if mode != "subscribe" or not STRAVA_VERIFY_TOKEN or token != STRAVA_VERIFY_TOKEN:
+        raise HTTPException(403, "verify_token inválido")
+    return {"hub.challenge": challenge}
+
+@app.post(WEBHOOK_PATH)
+async def strava_webhook_event(ev: dict = Body(...)):
+    need = {"object_type", "object_id", "aspect_type", "owner_id"}
+    if not need.issubset(ev):
+        raise HTTPException(400, "Evento Strava incompleto")
+    # cada evento cuesta una llamada al presupuesto compartido de Strava:
+    # solo se encolan los de nuestra suscripción
+    if not STRAVA_SUBSCRIPTION or str(ev.get("subscription_id")) != STRAVA_SUBSCRIPTION:
+        log.warning("⚠️ Evento Strava de otra suscripción (%s) descartado", ev.get("subscription_id"))
+        raise HTTPException(403, "subscription_id inválido")
+    try:
+        webhook_queue.put_nowait(ev)
+    except asyncio.QueueFull:
+        # Strava reintenta los eventos que no reciben 200
+        log.warning("⚠️ Cola de webhooks llena, evento %s rechazado", ev["object_id"])
+        raise HTTPException(503, "Cola de webhooks llena")
+    return {"success": True}
+
 # ——— Strava “raw” activities ——————————————————————————————
+STRAVA_PAGE_SIZE = 200      # máximo per_page que acepta Strava
+STRAVA_SYNC_KEEP = 200      # actividades recientes que se guardan por usuario en memoria
+strava_lists     = TTLCache(maxsize=int(os.getenv("STRAVA_LIST_CACHE_SIZE", "2000")),
+                            ttl=int(os.getenv("STRAVA_LIST_CACHE_TTL", "3600")))
+
+def _sync_state_ref(uid: str):
+    return db.collection("users").document(uid).collection("strava_sync").document("state")
+
+def _strava_cache_col(uid: str):
+    return db.collection("users").document(uid).collection("strava_activities")
+
+async def _load_strava_list(uid: str) -> tuple:
+    """(watermark, lista) del usuario: de memoria o, si no está, de Firestore."""
+    hit = strava_lists.get(uid)
+    if hit:
+        return hit
+    state = await _sync_state_ref(uid).get()
+    if not state.exists:
+        return None, []
+    docs = _strava_cache_col(uid).order_by("date", direction=firestore.Query.DESCENDING)\
+                                 .limit(STRAVA_SYNC_KEEP).stream()
+    hit = (state.to_dict().get("watermark"), [d.to_dict() async for d in docs])
+    strava_lists[uid] = hit
+    return hit
+
+async def _merge_strava(uid: str, watermark: str, current: list, new: list) -> list:
+    """Persiste las actividades nuevas y el watermark y devuelve la lista
+    combinada (más recientes primero)."""
+    batch, ops = db.batch(), 0
+    for item in new:
+        batch.set(_strava_cache_col(uid).document(item["id"]), item)
+        ops += 1
+        if ops >= 499:
+            await batch.commit()
+            batch, ops = db.batch(), 0
+    batch.set(_sync_state_ref(uid), {"watermark": watermark, "syncedAt": time.time()})
+    await batch.commit()
+
+    by_id = {a["id"]: a for a in current}
+    by_id.update((a["id"], a) for a in new)
+    merged = sorted(by_id.values(), key=lambda a: a["date"], reverse=True)[:STRAVA_SYNC_KEEP]
+    strava_lists[uid] = (watermark, merged)
+    return merged
+
+async def sync_strava(uid: str) -> list:
+    """Sync incremental: solo pide a Strava lo posterior al watermark (el
+    start_date más reciente visto), paginando hasta agotar resultados. La
+    primera vez se siembra con la última página."""
+    token = await ensure_access_token(uid)
+    watermark, current = await _load_strava_list(uid)
+
+    raw = []
+    if watermark is None:
+        raw = await strava.activities(token, per_page=STRAVA_PAGE_SIZE)
+    else:
+        page = 1
+        while True:
+            chunk = await strava.activities(token, after=_epoch(watermark),
+                                      per_page=STRAVA_PAGE_SIZE, page=page)
+            raw.extend(chunk)
+            if len(chunk) < STRAVA_PAGE_SIZE:
+                break
+            page += 1
+
+    if not raw:
+        return current
+    new = [_fmt_strava(uid, a) for a in raw if a["type"] in ("Run", "Walk")]
+    watermark = max([a["start_date"] for a in raw] + ([watermark] if watermark else []))
+    log.info("🔁 Sync Strava %s: %d nuevas (watermark %s)", uid, len(new), watermark)
+    return await _merge_strava(uid, watermark, current, new)
+
+async def _push_strava(uid: str, item: dict = None, removed: str = None):
+    """Aplica un cambio llegado por webhook a la lista cacheada del usuario:
+    upsert de `item` o borrado de la actividad `removed`."""
+    watermark, current = await _load_strava_list(uid)
+    if removed is not None:
+        await _strava_cache_col(uid).document(removed).delete()
+        strava_lists[uid] = (watermark, [a for a in current if a["id"] != removed])
+        return
+    if watermark is not None and item["date"] > watermark:
+        watermark = item["date"]
+    await _merge_strava(uid, watermark, current, [item])
+
 @app.get("/users/{uid}/strava/activities")
-def strava_activities(uid: str, per_page: int = Query(100, le=200)):
-    token = ensure_access_token(uid)
-    r = requests.get(STRAVA_ACTIVITIES_URL,
-                     headers={"Authorization": f"Bearer {token}"},
-                     params={"per_page": per_page})
-    r.raise_for_status()
-    arr = r.json()
+async def strava_activities(
+    uid: str,
+    per_page: int = Query(100, le=200),
+    mode: str = Query("latest", description="latest, incremental o cached"),
+    polyline: str = Query("full", description="none, simplified (miniatura) o full"),
+):
+    polyline = _check_polyline(polyline)
+    if mode.lower() == "cached":
+        # lista mantenida por el webhook: no llama a Strava
+        arr = (await _load_strava_list(uid))[1][:per_page]
+        return ORJSONResponse({"activities": await _with_polyline(arr, polyline)})
+
+    try:
+        if mode.lower() == "incremental":
+            arr = (await sync_strava(uid))[:per_page]
+            log.info("📦 %d actividades Strava (sync) para %s", len(arr), uid)
+            return ORJSONResponse({"activities": await _with_polyline(arr, polyline)})
+
+        token = await ensure_access_token(uid)
+        arr   = await strava.activities(token, per_page=per_page)
+    except StravaBudgetExhausted:
+        # sin presupuesto: servir lo cacheado si existe
+        cached = (await _load_strava_list(uid))[1]
+        if not cached:
+            raise
+        log.info("🪫 Presupuesto Strava bajo, sirviendo caché para %s", uid)
+        return ORJSONResponse({"activities": await _with_polyline(cached[:per_page], polyline), "stale": True})
     log.info("📦 %d actividades Strava para %s", len(arr), uid)
-    return {"activities": [
-        {
-            "userID":           uid,
-            "id":               str(a["id"]),
-            "type":             a["type"],
-            "distance":         round(a["distance"] / 1000, 2),
-            "duration":         round(a["moving_time"] / 60, 2),
-            "elevation":        round(a["total_elevation_gain"], 2),
-            "avg_speed":        a.get("average_speed"),
-            "summary_polyline": a["map"]["summary_polyline"],
-            "date":             a["start_date"],
-            "includedInLeagues": [],
-            "likeCount": 0,
-            "didILike": False,
-            "commentCount": 0
-        }
-        for a in arr if a["type"] in ("Run", "Walk")
-    ]}
+    return ORJSONResponse({"activities": await _with_polyline(
+        [_fmt_strava(uid, a) for a in arr if a["type"] in ("Run", "Walk")], polyline)})
+
+# ——— Ranking: puntuación y standings materializados ———————————————
+
+def _standing_ref(lid: str, uid: str):
+    return db.collection("leagues").document(lid).collection("standings").document(uid)
+
+def _stored_agg(snap):
+    """Agregado guardado en `snap`; None si no existe o si aún tiene el
+    formato float anterior (lo reescriben rebuild-standings/rebuild-buckets)."""
+    d = snap.to_dict() if snap is not None and snap.exists else None
+    return d if d is not None and all(f in d for f in AGG_FIELDS) else None
+
+# ——— Ranking: buckets por día, semana ISO y mes ———————————————————
+# leagues/{lid}/buckets/{uid}_{clave}: mismos agregados que un standing,
+# limitados a un día (d2025-03-14), semana ISO (w2025-W11) o mes (m2025-03)
+BUCKET_PERIODS = ("day", "week", "month")
+BUCKET_IN_MAX  = 30                  # valores por filtro "in" de Firestore
+
+def _period_range(period: str, date_from: str, date_to: str):
+    try:
+        return periods.period_range(period, date_from, date_to)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+def _bucket_ref(lid: str, uid: str, key: str):
+    return db.collection("leagues").document(lid).collection("buckets").document(f"{uid}_{key}")
+
+def _bucket_doc(uid: str, period: str, key: str) -> dict:
+    return {"userID": uid, "period": period, "bucket": key, **{f: 0 for f in AGG_FIELDS}}
+
+async def _bucket_rows(lid: str, keys: list) -> list:
+    """Todos los buckets de la liga con clave en `keys`, con los "in" de 30
+    en 30 lanzados en paralelo."""
+    col    = db.collection("leagues").document(lid).collection("buckets")
+    chunks = [keys[i:i + BUCKET_IN_MAX] for i in range(0, len(keys), BUCKET_IN_MAX)]
+    async def one(chunk):
+        return [d.to_dict() async for d in col.where("bucket", "in", chunk).stream()]
+    return [row for rows in await asyncio.gather(*(one(c) for c in chunks)) for row in rows]
+
+async def rebuild_buckets():
+    """Comando one-off: recalcula leagues/{lid}/buckets desde las
+    actividades de cada liga (backfill o reparación) y marca la liga con
+    bucketsReady; hasta entonces los rankings por rango van a actividades."""
+    async for league in db.collection("leagues").list_documents():
+        async for d in league.collection("buckets").list_documents():
+            await d.delete()
+        per_key = defaultdict(list)
+        async for d in league.collection("activities").stream():
+            a = d.to_dict()
+            for period, key in periods.bucket_keys(a["date"]).items():
+                per_key[(a["userID"], period, key)].append(a)
+        items = list(per_key.items())
+        for i in range(0, len(items), FIRESTORE_MAX_WRITES):
+            batch = db.batch()
+            for (uid, period, key), arr in items[i:i + FIRESTORE_MAX_WRITES]:
+                batch.set(league.collection("buckets").document(f"{uid}_{key}"),
+                          {**_bucket_doc(uid, period, key), **ranking.totals(arr)})
+            await batch.commit()
+        batch = db.batch()
+        batch.set(league, {"bucketsReady": True}, merge=True)
+        _bump_version(batch, league, "version")
+        await batch.commit()
+        log.info("🗓️ Buckets de liga %s: %d", league.id, len(items))
+
+async def migrate_dates():
+    """Comando one-off: convierte a timestamp nativo los `date` ISO de
+    activities y de todas las copias de liga (collection group)."""
+    batch, pending, done = db.batch(), 0, 0
+    async for d in db.collection_group("activities").select(["date"]).stream():
+        v = d.get("date")
+        if not isinstance(v, str):
+            continue
+        batch.update(d.reference, {"date": periods.to_ts(v)})
+        pending += 1
+        if pending == FIRESTORE_MAX_WRITES:
+            await batch.commit()
+            batch, done, pending = db.batch(), done + pending, 0
+    if pending:
+        await batch.commit()
+    log.info("🕒 Fechas migradas a timestamp: %d", done + pending)
+
+GEOMETRY_BATCH    = 500
+GEOMETRY_INFLIGHT = 4                # lotes decodificándose/escribiéndose a la vez
+
+async def backfill_geometry():
+    """Comando one-off: decodifica summary_polyline de las actividades que aún
+    no tienen geometría y la guarda en ellas y en sus copias de liga. Los
+    lotes se decodifican (vectorizado) en un pool de procesos mientras el
+    bucle sigue leyendo y escribiendo."""
+    loop, done = asyncio.get_running_loop(), 0
+
+    async def flush(items, fut):
+        nonlocal done
+        # set con merge crearía copias sueltas en ligas donde falta la copia
+        copies = {d.id: _copy_refs(d) for d in items}
+        found  = {s.reference.path for s in await _get_all([r for rs in copies.values() for r in rs]) if s.exists}
+        batch, ops = db.batch(), 0
+        for d, summary in zip(items, await fut):
+            if summary is None:
+                continue
+            for r in [d.reference] + [r for r in copies[d.id] if r.path in found]:
+                batch.set(r, summary, merge=True)
+                ops += 1
+                if ops == FIRESTORE_MAX_WRITES:
+                    await batch.commit()
+                    batch, ops = db.batch(), 0
+            done += 1
+        if ops:
+            await batch.commit()
+
+    with ProcessPoolExecutor() as pool:
+        items, polys, flushes = [], [], []
+        q = db.collection("activities").select(["summary_polyline", "start_geohash", "includedInLeagues"])
+        async for d in q.stream():
+            a = d.to_dict()
+            if not a.get("summary_polyline") or a.get("start_geohash"):
+                continue
+            items.append(d)
+            polys.append(a["summary_polyline"])
+            if len(items) == GEOMETRY_BATCH:
+                fut = loop.run_in_executor(pool, geometry.route_summaries, polys, POLYLINE_THUMB_PX)
+                flushes.append(asyncio.ensure_future(flush(items, fut)))
+                items, polys = [], []
+                if len(flushes) >= GEOMETRY_INFLIGHT:
+                    await flushes.pop(0)
+        if items:
+            fut = loop.run_in_executor(pool, geometry.route_summaries, polys, POLYLINE_THUMB_PX)
+            flushes.append(asyncio.ensure_future(flush(items, fut)))
+        await asyncio.gather(*flushes)
+    log.info("🗺️ Geometría calculada para %d actividades", done)
+
+# Firestore admite 500 escrituras por commit: primaria (o sus ligas) y
+# versión del usuario y, por liga, copia, standing, versión y hasta 6 buckets
+# (los 3 de la fecha anterior y los 3 de la nueva)
+FIRESTORE_MAX_WRITES = 500
+LEAGUES_PER_COMMIT   = (FIRESTORE_MAX_WRITES - 2) // 9
+
+@firestore.async_transactional
+async def _save_fanout_tx(transaction, doc_id: str, base: dict, leagues: list, primary: bool):
+    """Escribe en un único commit el doc primario (si `primary`; si no, suma
+    `leagues` a su includedInLeagues), las copias de `leagues`, sus
+    leagues/{lid}/standings/{uid} y los buckets afectados. Las lecturas
+    previas van en dos get_all: copias + standings + ligas (sus marcas de
+    backfill), y buckets (que dependen de la fecha anterior de cada copia)."""
+    uid    = base["userID"]
+    copies = {lid: db.collection("leagues").document(lid).collection("activities").document(doc_id)
+              for lid in leagues}
+    stands = {lid: _standing_ref(lid, uid) for lid in leagues}
+    metas  = {lid: db.collection("leagues").document(lid) for lid in leagues}
+    snaps  = {snap.reference.path: snap for snap in await _get_all(
+              [*copies.values(), *stands.values(), *metas.values()], transaction=transaction)}
+
+    new_keys = periods.bucket_keys(base["date"])
+    olds, touched = {}, {}
+    for lid in leagues:
+        old = snaps.get(copies[lid].path)
+        olds[lid] = old = old.to_dict() if old is not None and old.exists else None
+        keys = dict.fromkeys([*(periods.bucket_keys(old["date"]).items() if old else ()), *new_keys.items()])
+        touched[lid] = {(period, key): _bucket_ref(lid, uid, key) for period, key in keys}
+    bucket_snaps = {snap.reference.path: snap for snap in await _get_all(
+        [ref for refs in touched.values() for ref in refs.values()], transaction=transaction)}
+
+    async def others_in(col, start=None, end=None) -> list:
+        # el resto de copias del usuario en la liga (o en el rango)
+        q = col.where("userID", "==", uid)
+        if start is not None:
+            q = q.where("date", ">=", start).where("date", "<", end)
+        return [d.to_dict() async for d in q.stream(transaction=transaction) if d.id != doc_id]
+
+    async def longest_in(col, start=None, end=None):
+        # la tirada más larga se ha acortado: recalcular con el resto
+        return max([0] + [a["distance"] for a in await others_in(col, start, end)])
+
+    async def fresh_agg(empty: dict, col, new, start=None, end=None) -> dict:
+        # fila que falta en una liga sin backfill: empezar de cero perdería
+        # las actividades previas del usuario (y restar `old` dejaría totales
+        # negativos), se suma el resto de copias desde cero
+        agg = {**empty, **ranking.totals(await others_in(col, start, end))}
+        ranking.apply_activity(agg, None, new)
+        return agg
+
+    writes = {}                      # ref -> agregados (None: borrar el bucket)
+    for lid in leagues:
+        old, st = olds[lid], snaps.get(stands[lid].path)
+        meta    = snaps.get(metas[lid].path)
+        meta    = (meta.to_dict() or {}) if meta is not None else {}
+        same_vals = old is not None and all(old.get(f) == base[f] for f in ("distance", "duration", "elevation"))
+        if same_vals and periods.bucket_keys(old["date"]) == new_keys:
+            continue
+
+        if not same_vals:
+            agg = _stored_agg(st)
+            if agg is None and (old is not None or not meta.get("standingsReady")):
+                agg = await fresh_agg({"userID": uid}, copies[lid].parent, base)
+            else:
+                agg = agg or {"userID": uid, **{f: 0 for f in AGG_FIELDS}}
+                if ranking.apply_activity(agg, old, base):
+                    agg["longest"] = max(base["distance"], await longest_in(copies[lid].parent))
+            writes[stands[lid]] = agg
+
+        old_keys = set(periods.bucket_keys(old["date"]).values()) if old else set()
+        for (period, key), ref in touched[lid].items():
+            agg = _stored_agg(bucket_snaps.get(ref.path))
+            new = base if new_keys[period] == key else None
+            if agg is None and (key in old_keys or not meta.get("bucketsReady")):
+                agg = await fresh_agg(_bucket_doc(uid, period, key), copies[lid].parent, new,
+                                      *periods.bucket_span(key))
+            else:
+                agg = agg or _bucket_doc(uid, period, key)
+                if ranking.apply_activity(agg, old if key in old_keys else None, new):
+                    agg["longest"] = max(new["distance"] if new else 0,
+                                         await longest_in(copies[lid].parent, *periods.bucket_span(key)))
+            writes[ref] = agg if agg["runs"] > 0 else None
+
+    # merge para no pisar likeCount/commentCount de una actividad re-guardada;
+    # el primario solo lista las ligas cuyas copias entran en este commit o
+    # en uno anterior, para que no nombre ligas sin copia si otro falla
+    primary_ref = db.collection("activities").document(doc_id)
+    if primary:
+        transaction.set(primary_ref, {**base, "includedInLeagues": leagues}, merge=True)
+    elif leagues:
+        transaction.set(primary_ref, {"includedInLeagues": firestore.ArrayUnion(leagues)}, merge=True)
+    _bump_versions(transaction, leagues, uid if primary else None)
+    for copy_ref in copies.values():
+        transaction.set(copy_ref, base, merge=True)
+    for ref, data in writes.items():
+        if data is None:
+            transaction.delete(ref)
+        else:
+            transaction.set(ref, data)
+
+    # {lid: polyline anterior o None} de las copias con ruta nueva o distinta
+    poly = base.get("summary_polyline")
+    return {lid: (old or {}).get("summary_polyline") for lid, old in olds.items()
+            if poly and (old is None or old.get("summary_polyline") != poly)}
+
+async def rebuild_standings():
+    """Comando one-off: recalcula leagues/{lid}/standings desde las
+    actividades de cada liga (backfill o reparación) y marca la liga con
+    standingsReady: hasta entonces el ranking general no se fía de unos
+    standings que solo tendrían a quien guardó después del despliegue."""
+    async for league in db.collection("leagues").list_documents():
+        buckets = defaultdict(list)
+        async for d in league.collection("activities").stream():
+            a = d.to_dict()
+            buckets[a["userID"]].append(a)
+        items = list(buckets.items())
+        for i in range(0, len(items), FIRESTORE_MAX_WRITES):
+            batch = db.batch()
+            for uid, arr in items[i:i + FIRESTORE_MAX_WRITES]:
+                batch.set(league.collection("standings").document(uid),
+                          {"userID": uid, **ranking.totals(arr)})
+            await batch.commit()
+        batch = db.batch()
+        batch.set(league, {"standingsReady": True}, merge=True)
+        _bump_version(batch, league, "version")
+        await batch.commit()
+        log.info("🏁 Standings de liga %s: %d usuarios", league.id, len(buckets))
 
 # ——— CRUD propias ————————————————————————————————————————
 @app.get("/activities/{uid}")
-def activities_by_user(uid: str):
-    docs = db.collection("activities").where("userID", "==", uid).stream()
-    return {"activities": [_fmt_act(d.to_dict()) for d in docs]}
+async def activities_by_user(
+    uid: str,
+    limit:  int = Query(None, ge=1, le=500, description="Tamaño de página (más recientes primero)"),
+    cursor: str = Query(None, description="nextCursor de la página anterior"),
+    fields: str = Query(None, description="Campos a devolver, separados por comas"),
+    polyline: str = Query("full", description="none, simplified (miniatura) o full"),
+    if_none_match: str = Header(None),
+):
+    polyline = _check_polyline(polyline)
+    version, _ = await _read_version(db.collection("users").document(uid), "activitiesVersion")
+    etag = _etag("activities", uid, version,
+                 limit, cursor, fields, polyline)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    headers = _etag_headers(etag)
+
+    q = db.collection("activities").where("userID", "==", uid)
+
+    sel = None
+    if fields:
+        sel = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = set(sel) - ACT_FIELDS.keys()
+        if unknown:
+            raise HTTPException(400, f"Campos desconocidos: {', '.join(sorted(unknown))}")
+        q = q.select(sorted({"activityID", "likesSharded"} |
+                            {ACT_FIELDS[f] for f in sel if ACT_FIELDS[f]}))
+
+    if limit is None and cursor is None:
+        docs = [d async for d in q.stream()]
+    else:
+        limit = limit or 100
+        q = q.order_by("date", direction=firestore.Query.DESCENDING)
+        if cursor:
+            last = await db.collection("activities").document(cursor).get()
+            if not last.exists or last.get("userID") != uid:
+                raise HTTPException(400, "cursor inválido")
+            q = q.start_after(last)
+        docs = [d async for d in q.limit(limit).stream()]
+
+    acts = {d.id: d.to_dict() for d in docs}
+    sharded = await _sharded_like_counts([a for a, d in acts.items() if d.get("likesSharded")])
+    for a, n in sharded.items():
+        acts[a]["likeCount"] = n
+
+    fmt = (lambda d: _project(d, sel)) if sel else _fmt_act
+    out = {"activities": await _with_polyline([fmt(d) for d in acts.values()], polyline)}
+    if limit is not None:
+        out["nextCursor"] = docs[-1].id if len(docs) == limit else None
+    return ORJSONResponse(out, headers=headers)
 
 @app.post("/activities/save")
-def save_activity(p: dict = Body(...)):
+async def save_activity(p: dict = Body(...)):
     need = {"userID", "id", "type", "distance", "duration",
             "elevation", "date", "includedInLeagues"}
     if not need.issubset(p):
         raise HTTPException(400, "Faltan campos en /activities/save")
 
     doc_id = f"{p['userID']}_{p['id']}"
-    base = {k: p[k] for k in ("userID", "type", "distance", "duration", "elevation", "date")}
+    base = {k: p[k] for k in ("userID", "type", "distance", "duration", "elevation")}
+    if not isinstance(p["date"], str):
+        raise HTTPException(400, "date inválida, se espera ISO 8601")
+    try:
+        base["date"] = periods.to_ts(p["date"])
+    except ValueError:
+        raise HTTPException(400, "date inválida, se espera ISO 8601")
     base["activityID"] = str(p["id"])
 
     if "avg_speed"        in p: base["avg_speed"]        = p["avg_speed"]
-    if "summary_polyline" in p: base["summary_polyline"] = p["summary_polyline"]
+    if "summary_polyline" in p:
+        base["summary_polyline"] = p["summary_polyline"]
+        base.update(_route_fields(p["summary_polyline"]))
     base["includedInLeagues"] = p["includedInLeagues"]
 
-    db.collection("activities").document(doc_id).set(base)
-    for lg in p["includedInLeagues"]:
-        db.collection("leagues").document(lg).collection("activities")\
-            .document(doc_id).set(base)
+    # primario + copias de liga en commits atómicos de hasta 500 escrituras
+    leagues  = list(dict.fromkeys(p["includedInLeagues"]))
+    chunks   = [leagues[i:i + LEAGUES_PER_COMMIT]
+                for i in range(0, len(leagues), LEAGUES_PER_COMMIT)] or [[]]
+    outcome  = {}
+    routes   = {}
+    saved    = False
+    for i, chunk in enumerate(chunks):
+        try:
+            routes.update(await _save_fanout_tx(db.transaction(), doc_id, base, chunk, primary=(i == 0)))
+            saved = saved or i == 0
+            outcome.update((lid, "ok") for lid in chunk)
+        except Exception:
+            log.exception("❌ Error guardando %s en ligas %s", doc_id, chunk)
+            outcome.update((lid, "error") for lid in chunk)
+            if i == 0:
+                break
+    outcome.update((lid, "skipped") for lid in leagues if lid not in outcome)
+    if routes:
+        await _update_heatmaps(base["summary_polyline"], routes)
 
-    return {"success": True}
+    return {"success": saved and all(v == "ok" for v in outcome.values()),
+            "leagues": outcome}
+
+# ——— Liga: caché de feeds invalidada por listeners ———————————————————
+# Una entrada por liga con sus vistas formateadas (una por rango pedido) y
+# un listener on_snapshot sobre leagues/{lid}/activities: cualquier cambio en
+# las copias (guardado, likes y comentarios tocan sus contadores) vacía las
+# vistas. El AsyncClient no tiene listeners: van en un Client síncrono, cuyos
+# callbacks llegan desde su hilo.
+FEED_CACHE_LEAGUES = int(os.getenv("FEED_CACHE_LEAGUES", "200"))   # listeners abiertos
+FEED_CACHE_VIEWS   = int(os.getenv("FEED_CACHE_VIEWS", "8"))       # rangos por liga
+listen_db = None
+
+class LeagueFeed:
+    """Vistas cacheadas de una liga. `ready` pasa a True con el primer
+    snapshot del listener (antes no se cachea: un cambio previo se perdería)
+    y cada cambio posterior sube `gen`, que descarta las vistas calculadas
+    con datos anteriores. Si el stream del listener se cierra (error no
+    reintentable) dejan de llegar snapshots: la entrada deja de servir y
+    `_league_feed` la sustituye por una suscripción nueva."""
+
+    def __init__(self, lid: str):
+        self.lock  = threading.Lock()
+        self.ready = False
+        self.gen   = 0
+        self.views = LRUCache(maxsize=FEED_CACHE_VIEWS)
+        self.watch = listen_db.collection("leagues").document(lid)\
+                              .collection("activities").on_snapshot(self._on_snapshot)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self.lock:
+            if self.ready:
+                self.gen += 1
+                self.views.clear()
+            self.ready = True
+
+    @property
+    def active(self) -> bool:
+        return self.watch.is_active
+
+    def get(self, key):
+        with self.lock:
+            if not self.active:
+                return self.gen, False, None
+            return self.gen, self.ready, self.views.get(key)
+
+    def put(self, key, gen: int, view: FeedView):
+        with self.lock:
+            if self.ready and gen == self.gen and self.active:
+                self.views[key] = view
+
+def _close_watch(watch):
+    """Cierra un listener fuera del bucle de eventos: unsubscribe espera al
+    hilo consumidor del stream (hasta 1 s) y pararía el worker entero."""
+    asyncio.get_running_loop().run_in_executor(None, watch.unsubscribe)
+
+class _FeedCache(LRUCache):
+    """LRU de ligas; al expulsar una se cierra su listener."""
+    def popitem(self):
+        lid, feed = super().popitem()
+        _close_watch(feed.watch)
+        return lid, feed
+
+feed_cache = _FeedCache(maxsize=max(FEED_CACHE_LEAGUES, 1))
+
+def _league_feed(lid: str):
+    global listen_db
+    if FEED_CACHE_LEAGUES <= 0:
+        return None
+    feed = feed_cache.get(lid)
+    if feed is not None and not feed.active:
+        log.warning("⚠️ Listener del feed de liga %s cerrado, se vuelve a suscribir", lid)
+        _close_watch(feed.watch)
+        del feed_cache[lid]
+        feed = None
+    if feed is None:
+        if listen_db is None:
+            listen_db = firestore.Client(credentials=credentials)
+        feed = feed_cache[lid] = LeagueFeed(lid)
+    return feed
 
 # ——— Liga: actividades con social —————————————————————————
 @app.get("/league/{lid}/activities")
-def league_activities(
+async def league_activities(
     lid: str,
-    user_id: str = Query(None, alias="userID")
+    user_id: str = Query(None, alias="userID"),
+    period: str = Query("general", description="general, weekly (semana ISO en curso) o monthly (mes en curso)"),
+    date_from: str = Query(None, alias="from", description="YYYY-MM-DD; tiene prioridad sobre period"),
+    date_to: str = Query(None, alias="to", description="YYYY-MM-DD incluido; por defecto hoy"),
+    polyline: str = Query("full", description="none, simplified (miniatura) o full"),
+    if_none_match: str = Header(None),
 ):
+    polyline = _check_polyline(polyline)
     log.info("📥 solicitadas actividades de liga %s para user %s", lid, user_id)
-    docs = db.collection("leagues").document(lid).collection("activities").stream()
-    activities = []
-    for d in docs:
-        a = d.to_dict()
-        act_id = d.id
-
-        # likes
-        likes_doc = db.collection("activities")\
-                      .document(act_id)\
-                      .collection("social")\
-                      .document("likes").get()
-        users = likes_doc.to_dict().get("users", []) if likes_doc.exists else []
-        like_count = len(users)
-        did_i_like = (user_id in users) if user_id else False
-
-        # comments
-        comments = db.collection("activities")\
-                     .document(act_id)\
-                     .collection("comments").stream()
-        comment_count = sum(1 for _ in comments)
-
-        entry = _fmt_act(a)
-        entry["likeCount"]    = like_count
-        entry["didILike"]     = did_i_like
-        entry["commentCount"] = comment_count
-        activities.append(entry)
+    rng  = _period_range(period, date_from, date_to)
+    version, _ = await _read_version(db.collection("leagues").document(lid), "version")
+    etag = _etag("feed", lid, version, rng, user_id, polyline)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    headers = _etag_headers(etag)
+
+    feed = _league_feed(lid)
+    gen, ready, view = feed.get(rng) if feed else (0, False, None)
+    # el listener invalida con retraso: una vista de una versión anterior
+    # (commit aún no notificado) serviría datos viejos bajo el ETag nuevo
+    if view is not None and view.version != version:
+        view = None
+    if view is None:
+        q = db.collection("leagues").document(lid).collection("activities")
+        if rng:
+            # filtro en el servidor: solo se leen los docs del rango
+            q = q.where("date", ">=", periods.day_start(rng[0])) \
+                 .where("date", "<", periods.day_start(rng[1] + timedelta(days=1)))
+        view = await _build_feed({d.id: d.to_dict() async for d in q.stream()}, version)
+        if ready:
+            feed.put(rng, gen, view)
+
+    return ORJSONResponse({"activities": await _with_polyline(await _overlay_feed(view, user_id), polyline)},
+                          headers=headers)
+
+# ——— Liga: reglas de puntuación ———————————————————————————————
+# compiladas una vez por (liga, versión); cada cambio de reglas sube la versión
+rules_cache = LRUCache(maxsize=int(os.getenv("RULES_CACHE_SIZE", "1000")))
+
+def _league_rules(lid: str, spec: dict) -> "ranking.ScoringRules":
+    if not spec:
+        return ranking.DEFAULT
+    key = (lid, spec.get("version", 0))
+    rules = rules_cache.get(key)
+    if rules is None:
+        try:
+            rules = ranking.compile_rules(spec)
+        except ValueError as e:
+            log.warning("⚠️ Reglas de la liga %s inválidas (%s); se usan las de defecto", lid, e)
+            rules = ranking.DEFAULT
+        rules_cache[key] = rules
+    return rules
 
-    return {"activities": activities}
+@firestore.async_transactional
+async def _set_rules_tx(transaction, ref, spec: dict) -> int:
+    snap = await ref.get(transaction=transaction, field_paths=["scoring"])
+    if not snap.exists:
+        raise HTTPException(404, "Liga no encontrada")
+    version = int((snap.to_dict().get("scoring") or {}).get("version", 0)) + 1
+    transaction.update(ref, {"scoring": {**spec, "version": version}})
+    _bump_version(transaction, ref, "version")
+    return version
 
-# ——— Liga: ranking (general o weekly) —————————————————————————
+@app.get("/league/{lid}/scoring")
+async def get_league_rules(lid: str):
+    snap = await db.collection("leagues").document(lid).get(field_paths=["scoring"])
+    if not snap.exists:
+        raise HTTPException(404, "Liga no encontrada")
+    try:
+        return {"scoring": ranking.merge_rules(snap.to_dict().get("scoring"))}
+    except ValueError as e:
+        raise HTTPException(500, f"Reglas guardadas inválidas: {e}")
+
+@app.put("/league/{lid}/scoring")
+async def set_league_rules(lid: str, spec: dict = Body(...)):
+    spec = {k: v for k, v in spec.items() if k != "version"}
+    try:
+        ranking.compile_rules(spec)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    version = await _set_rules_tx(db.transaction(), db.collection("leagues").document(lid), spec)
+    return {"success": True, "version": version}
+
+# ——— Liga: ranking (general, weekly, monthly o rango) ——————————————
 @app.get("/league/{lid}/ranking")
-def league_ranking(
+async def league_ranking(
     lid: str,
-    period: str = Query("general", description="general o weekly")
+    period: str = Query("general", description="general, weekly (semana ISO en curso) o monthly (mes en curso)"),
+    date_from: str = Query(None, alias="from", description="YYYY-MM-DD; rango por días, tiene prioridad sobre period"),
+    date_to: str = Query(None, alias="to", description="YYYY-MM-DD incluido; por defecto hoy"),
+    if_none_match: str = Header(None),
+):
+    rng  = _period_range(period, date_from, date_to)
+    keys = periods.range_keys(*rng) if rng else None  # weekly/monthly: un bucket
+    league = db.collection("leagues").document(lid)
+    version, meta = await _read_version(league, "version", ["scoring", "standingsReady", "bucketsReady"])
+    etag   = _etag("ranking", lid, version, rng)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    headers = _etag_headers(etag)
+
+    log.info("📊 calculando ranking %s para liga %s", date_from and f"{date_from}..{date_to or ''}" or period, lid)
+    rules  = _league_rules(lid, meta.get("scoring"))
+    if keys is not None and meta.get("bucketsReady"):
+        # unos pocos buckets por usuario, sumados en el motor columnar
+        cols = ranking.aggregate(ranking.from_buckets(await _bucket_rows(lid, keys)))
+    elif keys is not None:
+        # liga sin backfill de buckets: las actividades del rango
+        q = league.collection("activities").where("date", ">=", periods.day_start(rng[0])) \
+                  .where("date", "<", periods.day_start(rng[1] + timedelta(days=1)))
+        cols = ranking.aggregate(ranking.from_activities([d.to_dict() async for d in q.stream()]))
+    elif meta.get("standingsReady"):
+        totals = {d.id: d.to_dict() async for d in league.collection("standings").stream()}
+        cols = ranking.from_totals(totals)
+    else:
+        # liga sin backfill de standings: agregar desde las actividades
+        acts = [d.to_dict() async for d in league.collection("activities").stream()]
+        cols = ranking.aggregate(ranking.from_activities(acts))
+
+    scored = ranking.rank(cols, rules)
+    nicks  = await resolve_nicknames(uid for uid, _ in scored)
+    rank   = [{"userID": uid, "nickname": nicks[uid], "points": pts} for uid, pts in scored]
+    return ORJSONResponse({"ranking": rank}, headers=headers)
+
+# ——— Cerca de mí: actividades o usuarios por punto de salida ———————————
+# filtro grueso en Firestore (rango de prefijo sobre start_geohash por cada
+# celda que cubre el círculo, en paralelo) y fino con haversine vectorizado
+NEARBY_FIELDS = ["userID", "activityID", "type", "distance", "duration",
+                 "elevation", "date", "start_latlng"]
+
+async def _nearby_candidates(col, cells: list) -> list:
+    async def one(prefix):
+        q = col.where("start_geohash", ">=", prefix).where("start_geohash", "<", prefix + "~")
+        return [d.to_dict() async for d in q.select(NEARBY_FIELDS).stream()]
+    return [d for docs in await asyncio.gather(*(one(c) for c in cells)) for d in docs]
+
+@app.get("/nearby")
+async def nearby(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(5, gt=0, le=50),
+    kind: str = Query("activities", description="activities o users"),
+    league: str = Query(None, description="Limitar a las actividades de una liga"),
+    limit: int = Query(50, ge=1, le=500),
 ):
-    log.info("📊 calculando ranking %s para liga %s", period, lid)
-    docs = db.collection("leagues").document(lid).collection("activities").stream()
-    acts = [d.to_dict() for d in docs]
-    if period.lower() == "weekly":
-        cutoff = datetime.utcnow() - timedelta(days=7)
-        acts = [a for a in acts if datetime.fromisoformat(a["date"].replace("Z", "")) >= cutoff]
-
-    buckets = defaultdict(list)
-    for a in acts:
-        buckets[a["userID"]].append(a)
-
-    def score(arr):
-        pts = 0
-        # 1) distancia
-        dist = sum(a["distance"] for a in arr)
-        pts += min(60, int(dist))
-        # 2) ritmo
-        time_m = sum(a["duration"] for a in arr)
-        spkph  = dist/(time_m/60) if time_m > 0 else 0
-        pace   = (1/spkph)*60 if spkph > 0 else float('inf')
-        if pace <= 5:      pts += 60
-        elif pace >= 7.5:  pts += 0
-        else:              pts += round((7.5 - pace)/(7.5 - 5)*60)
-        # 3) desnivel
-        elev = sum(a["elevation"] for a in arr)
-        pts += min(30, int(elev/10))
-        # 4) carreras
-        runs = len(arr)
-        pts += min(30, runs*10)
-        # 5) tirada larga
-        longest = max((a["distance"] for a in arr), default=0)
-        if   longest >= 15: pts += 30
-        elif longest >= 10: pts += 20
-        elif longest >= 5:  pts += 10
-        # 6) bonus
-        if runs >= 3:      pts += 20
-        return pts
-
-    rank = []
-    for uid, arr in buckets.items():
-        nick = db.collection("users").document(uid).get().to_dict().get("nickname", "Usuario")
-        rank.append({"userID": uid, "nickname": nick, "points": score(arr)})
-    rank.sort(key=lambda x: x["points"], reverse=True)
-    return {"ranking": rank}
+    kind = kind.lower()
+    if kind not in ("activities", "users"):
+        raise HTTPException(400, "kind debe ser activities o users")
+    col = db.collection("leagues").document(league).collection("activities") if league \
+          else db.collection("activities")
+    cands = [d for d in await _nearby_candidates(col, geometry.covering_cells(lat, lng, radius_km))
+             if d.get("start_latlng")]
+    if not cands:
+        return ORJSONResponse({kind: []})
+
+    starts = np.array([d["start_latlng"] for d in cands], dtype=np.float64)
+    dist   = geometry.haversine_km(lat, lng, starts[:, 0], starts[:, 1])
+    order  = [i for i in np.argsort(dist, kind="stable") if dist[i] <= radius_km]
+
+    # sin coordenadas ni distancias finas en la respuesta: la salida de una
+    # carrera suele ser la casa de quien corre
+    if kind == "activities":
+        out = [{**_project(cands[i], ACT_REQUIRED), "distanceKm": round(float(dist[i]), 1)}
+               for i in order[:limit]]
+        return ORJSONResponse({"activities": out})
+
+    # users: la salida más cercana de cada uno
+    closest = {}
+    for i in order:
+        closest.setdefault(cands[i]["userID"], i)
+        if len(closest) == limit:
+            break
+    nicks = await resolve_nicknames(closest)
+    return ORJSONResponse({"users": [
+        {"userID": uid, "nickname": nicks[uid], "activityID": str(cands[i].get("activityID")),
+         "distanceKm": round(float(dist[i]), 1)}
+        for uid, i in closest.items()]})
+
+# ——— Liga: heatmap por tiles ———————————————————————————————————
+# Densidad de las rutas de la liga por tile web-mercator z/x/y, en
+# leagues/{lid}/heatmap/{z}_{x}_{y}: TILE_SIZE² cuentas uint32 comprimidas
+# con zlib. save_activity suma las rutas nuevas (y resta la anterior si
+# cambia); rebuild-heatmap los recalcula desde las copias de la liga.
+HEATMAP_ZOOMS = tuple(int(z) for z in os.getenv("HEATMAP_ZOOMS", "10,12,14").split(","))
+HEATMAP_BATCH = 500                  # polylines decodificadas por lote al reconstruir
+
+def _heatmap_ref(lid: str, z: int, x: int, y: int):
+    return db.collection("leagues").document(lid).collection("heatmap").document(f"{z}_{x}_{y}")
+
+def _heatmap_doc(z: int, x: int, y: int, counts) -> dict:
+    return {"z": z, "x": x, "y": y, "size": geometry.TILE_SIZE, "counts": geometry.encode_tile(counts)}
+
+def _heatmap_delta(poly: str, old: str = None) -> dict:
+    """{(z, x, y): cuentas} de `poly` menos las de `old`, sin tiles a cero."""
+    new, *prev = geometry.decode_lenient([poly] + ([old] if old else []))
+    delta = geometry.heatmap_tiles([new], HEATMAP_ZOOMS)
+    geometry.heatmap_tiles(prev, HEATMAP_ZOOMS, acc=delta, sign=-1)
+    return {k: v for k, v in delta.items() if v.any()}
+
+@firestore.async_transactional
+async def _heatmap_tx(transaction, lid: str, delta: dict):
+    refs  = {k: _heatmap_ref(lid, *k) for k in delta}
+    snaps = {s.reference.path: s for s in await _get_all(list(refs.values()), transaction=transaction)}
+    for k, ref in refs.items():
+        s = snaps.get(ref.path)
+        counts = delta[k] + (geometry.decode_tile(s.get("counts")) if s is not None and s.exists else 0)
+        if (counts > 0).any():
+            transaction.set(ref, _heatmap_doc(*k, np.maximum(counts, 0)))
+        else:
+            transaction.delete(ref)
+
+async def _update_heatmaps(poly: str, routes: dict):
+    """Aplica la ruta guardada a los heatmaps de `routes` ({lid: polyline
+    anterior o None}). Un fallo solo se registra: el guardado ya está hecho
+    y rebuild-heatmap lo repara."""
+    deltas = {old: _heatmap_delta(poly, old) for old in set(routes.values())}
+    lids   = [lid for lid, old in routes.items() if deltas[old]]
+    res    = await asyncio.gather(*(_heatmap_tx(db.transaction(), lid, deltas[routes[lid]]) for lid in lids),
+                                  return_exceptions=True)
+    for lid, r in zip(lids, res):
+        if isinstance(r, Exception):
+            log.error("❌ Error actualizando heatmap de liga %s: %s", lid, r)
+
+async def rebuild_heatmap():
+    """Comando one-off: recalcula leagues/{lid}/heatmap desde las polylines
+    de las actividades de cada liga (backfill, cambio de HEATMAP_ZOOMS o
+    reparación)."""
+    async for league in db.collection("leagues").list_documents():
+        tiles, polys = {}, []
+        async for d in league.collection("activities").select(["summary_polyline"]).stream():
+            poly = d.to_dict().get("summary_polyline")
+            if poly:
+                polys.append(poly)
+            if len(polys) == HEATMAP_BATCH:
+                geometry.heatmap_tiles(geometry.decode_lenient(polys), HEATMAP_ZOOMS, acc=tiles)
+                polys = []
+        if polys:
+            geometry.heatmap_tiles(geometry.decode_lenient(polys), HEATMAP_ZOOMS, acc=tiles)
+
+        writes = [(r, None) async for r in league.collection("heatmap").list_documents()
+                  if tuple(map(int, r.id.split("_"))) not in tiles]          # tiles que ya no tienen rutas
+        writes += [(_heatmap_ref(league.id, *k), _heatmap_doc(*k, h)) for k, h in tiles.items()]
+        batch, ops = db.batch(), 0
+        for ref, data in writes:
+            if data is None:
+                batch.delete(ref)
+            else:
+                batch.set(ref, data)
+            ops += 1
+            if ops == FIRESTORE_MAX_WRITES:
+                await batch.commit()
+                batch, ops = db.batch(), 0
+        if ops:
+            await batch.commit()
+        log.info("🔥 Heatmap de liga %s: %d tiles", league.id, len(tiles))
+
+@app.get("/league/{lid}/heatmap/{z}/{x}/{y}")
+async def league_heatmap(
+    lid: str, z: int, x: int, y: int,
+    fmt: str = Query("png", alias="format", description="png (superponible) o raw (uint32 LE con zlib)"),
+    if_none_match: str = Header(None),
+):
+    if z not in HEATMAP_ZOOMS:
+        raise HTTPException(404, f"zoom no disponible ({', '.join(map(str, HEATMAP_ZOOMS))})")
+    if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(400, "tile fuera de rango")
+    if fmt not in ("png", "raw"):
+        raise HTTPException(400, "format debe ser png o raw")
+    snap = await _heatmap_ref(lid, z, x, y).get()
+    if not snap.exists:
+        return Response(status_code=204)           # tile sin rutas
+    etag = _etag("heatmap", lid, z, x, y, snap.update_time, fmt)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    headers = _etag_headers(etag)
+    if fmt == "raw":
+        return Response(snap.get("counts"), media_type="application/octet-stream",
+                        headers={**headers, "X-Tile-Size": str(snap.get("size"))})
+    counts = geometry.decode_tile(snap.get("counts"), snap.get("size"))
+    return Response(geometry.tile_png(counts), media_type="image/png", headers=headers)
 
 # ——— Likes & Comments (directos) ——————————————————————————
-@app.post("/activities/{act}/likes/{uid}")
-def toggle_like(act: str, uid: str):
-    ref   = db.collection("activities").document(act).collection("social").document("likes")
-    doc   = ref.get()
-    users = doc.to_dict().get("users", []) if doc.exists else []
+def _shard_likes(transaction, act: str, users: list, refs: list):
+    """Pasa una actividad popular al layout likes/{uid} + like_shards: a
+    partir de aquí cada toggle toca un doc de miembro y un shard al azar."""
+    for u in users:
+        transaction.set(_member_ref(act, u), {"userID": u})
+    for i, r in enumerate(_shard_refs(act)):
+        transaction.set(r, {"count": len(users) if i == 0 else 0})
+    transaction.set(_likes_ref(act), {"users": [], "sharded": True})
+    for r in refs:
+        transaction.update(r, {"likeCount": len(users), "likesSharded": True})
+
+@firestore.async_transactional
+async def _toggle_like_tx(transaction, act: str, uid: str):
+    """Devuelve (didLike, likeCount); likeCount es None en el layout sharded
+    (se suma fuera de la transacción para no bloquear los shards)."""
+    act_ref, likes_ref, member_ref = (db.collection("activities").document(act),
+                                      _likes_ref(act), _member_ref(act, uid))
+    snaps = {s.reference.path: s async for s in
+             db.get_all([act_ref, likes_ref, member_ref], transaction=transaction)}
+    likes = snaps[likes_ref.path]
+    likes = likes.to_dict() if likes.exists else {}
+
+    if likes.get("sharded"):
+        # O(1): un doc de miembro y un shard, sin tocar el doc de actividad
+        did = not snaps[member_ref.path].exists
+        if did: transaction.set(member_ref, {"userID": uid})
+        else:   transaction.delete(member_ref)
+        transaction.set(random.choice(_shard_refs(act)),
+                        {"count": firestore.Increment(1 if did else -1)}, merge=True)
+        _bump_activity_versions(transaction, snaps[act_ref.path])
+        return did, None
+
+    users = likes.get("users", [])
+    refs  = await _counter_refs(transaction, snaps[act_ref.path])
+    _bump_activity_versions(transaction, snaps[act_ref.path])
     did   = uid not in users
-    if did: users.append(uid)
-    else:   users.remove(uid)
-    ref.set({"users": users})
-    return {"success": True, "didLike": did, "likeCount": len(users)}
+    count = len(users) + (1 if did else -1)
+    if did and count >= LIKES_SHARD_THRESHOLD:
+        _shard_likes(transaction, act, users + [uid], refs)
+        return did, count
+
+    transaction.set(likes_ref, {"users": firestore.ArrayUnion([uid]) if did
+                                         else firestore.ArrayRemove([uid])}, merge=True)
+    _bump(transaction, refs, "likeCount", 1 if did else -1)
+    return did, count
+
+@app.post("/activities/{act}/likes/{uid}")
+async def toggle_like(act: str, uid: str):
+    did, count = await _toggle_like_tx(db.transaction(), act, uid)
+    if count is None:
+        count = (await _sharded_like_counts([act]))[act]
+    return {"success": True, "didLike": did, "likeCount": count}
 
 @app.get("/activities/{act}/comments")
-def get_comments(act: str):
+async def get_comments(act: str):
     docs = db.collection("activities").document(act).collection("comments")\
              .order_by("date").stream()
-    return {"comments": [d.to_dict() | {"id": d.id} for d in docs]}
+    return ORJSONResponse({"comments": [d.to_dict() | {"id": d.id} async for d in docs]})
+
+@firestore.async_transactional
+async def _add_comment_tx(transaction, act: str, cid: str, comment: dict):
+    snap = await _activity_snap(transaction, act)
+    refs = await _counter_refs(transaction, snap)
+    transaction.set(db.collection("activities").document(act)
+                      .collection("comments").document(cid), comment)
+    _bump(transaction, refs, "commentCount", 1)
+    _bump_activity_versions(transaction, snap)
 
 @app.post("/activities/{act}/comments")
-def add_comment(act: str, p: dict = Body(...)):
+async def add_comment(act: str, p: dict = Body(...)):
     need = {"userID", "nickname", "text"}
     if not need.issubset(p):
         raise HTTPException(400, "Faltan campos en POST /activities/{act}/comments")
     cid = str(uuid.uuid4())
-    db.collection("activities").document(act).collection("comments").document(cid).set({
+    await _add_comment_tx(db.transaction(), act, cid, {
         "userID":   p["userID"],
         "nickname": p["nickname"],
         "text":     p["text"],
@@ -320,13 +1799,39 @@ def add_comment(act: str, p: dict = Body(...)):
     })
     return {"success": True, "commentID": cid}
 
+@firestore.async_transactional
+async def _delete_comment_tx(transaction, act: str, cid: str):
+    ref  = db.collection("activities").document(act).collection("comments").document(cid)
+    doc  = await ref.get(transaction=transaction)
+    snap = await _activity_snap(transaction, act)
+    if not doc.exists:
+        return
+    refs = await _counter_refs(transaction, snap)
+    transaction.delete(ref)
+    _bump(transaction, refs, "commentCount", -1)
+    _bump_activity_versions(transaction, snap)
+
 @app.delete("/activities/{act}/comments/{cid}")
-def delete_comment(act: str, cid: str):
-    ref = db.collection("activities").document(act).collection("comments").document(cid)
-    ref.delete()
+async def delete_comment(act: str, cid: str):
+    await _delete_comment_tx(db.transaction(), act, cid)
     return {"success": True}
 
+COMMANDS = {
+    "backfill-counters": backfill_counters,
+    "rebuild-standings": rebuild_standings,
+    "rebuild-buckets":   rebuild_buckets,
+    "migrate-dates":     migrate_dates,
+    "backfill-geometry": backfill_geometry,
+    "rebuild-heatmap":   rebuild_heatmap,
+}
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        if sys.argv[1] not in COMMANDS:
+            raise SystemExit(f"Comando desconocido: {sys.argv[1]} ({', '.join(COMMANDS)})")
+        asyncio.run(COMMANDS[sys.argv[1]]())
+        raise SystemExit(0)
+
     import uvicorn
     uvicorn.run("app:app",
                 host="0.0.0.0",
@@ -0,0 +1,76 @@
+"""Benchmark y paridad de la decodificación de polylines: referencia escalar
+(`geometry.decode`, una a una) frente a `geometry.decode_many` (lote
+vectorizado), más el resumen de ruta completo en un proceso y en un pool y
+los tiles de heatmap de todas las rutas.
+
+    python benchmarks/bench_geometry.py --polylines 10000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import geometry  # noqa: E402
+
+PIXELS = 200
+ZOOMS  = (10, 12, 14)
+
+
+def polylines(n: int, seed: int = 7) -> list:
+    """Rutas tipo carrera: paseo aleatorio de 150-600 puntos (~10 m)."""
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        lat, lng = rnd.uniform(36, 43), rnd.uniform(-9, 3)
+        heading, pts = rnd.uniform(0, 6.28), []
+        for _ in range(rnd.randint(150, 600)):
+            heading += rnd.gauss(0, 0.3)
+            lat += 0.0001 * np.cos(heading)
+            lng += 0.0001 * np.sin(heading)
+            pts.append((lat, lng))
+        out.append(geometry.encode(pts))
+    return out
+
+
+def timed(fn) -> tuple:
+    t0 = time.perf_counter()
+    out = fn()
+    return out, (time.perf_counter() - t0) * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--polylines", type=int, default=10000)
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    args = ap.parse_args()
+
+    polys = polylines(args.polylines)
+    kib = sum(map(len, polys)) / 1024
+
+    ref, t_ref = timed(lambda: [geometry.decode(p) for p in polys])
+    vec, t_vec = timed(lambda: geometry.decode_many(polys))
+    assert all(np.array_equal(np.array(r).reshape(-1, 2), v) for r, v in zip(ref, vec)), "paridad rota"
+    print(f"paridad OK: {args.polylines} polylines, {kib:.0f} KiB, "
+          f"{sum(map(len, vec))} puntos")
+    print(f"  decode escalar:            {t_ref:9.1f} ms")
+    print(f"  decode_many (vectorizado): {t_vec:9.1f} ms  (x{t_ref / t_vec:.1f})")
+
+    _, t_sum = timed(lambda: geometry.route_summaries(polys, PIXELS))
+    print(f"  route_summaries, 1 proceso: {t_sum:8.1f} ms")
+    chunks = [polys[i:i + 500] for i in range(0, len(polys), 500)]
+    with ProcessPoolExecutor(args.workers) as pool:
+        list(pool.map(geometry.route_summaries, chunks[:args.workers], [PIXELS] * args.workers))  # calentar
+        _, t_pool = timed(lambda: list(pool.map(geometry.route_summaries, chunks, [PIXELS] * len(chunks))))
+    print(f"  route_summaries, pool de {args.workers}: {t_pool:7.1f} ms  (x{t_sum / t_pool:.1f})")
+
+    tiles, t_heat = timed(lambda: geometry.heatmap_tiles(vec, ZOOMS))
+    print(f"  heatmap_tiles z{ZOOMS}: {t_heat:8.1f} ms  ({len(tiles)} tiles)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark de serialización de un feed de liga: la ruta por defecto de
+FastAPI (jsonable_encoder + json.dumps de JSONResponse) frente a devolver
+ORJSONResponse directamente.
+
+    python benchmarks/bench_json.py --activities 1000
+"""
+import time
+import random
+import argparse
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+POLY_CHARS = "_~@?ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^`abcdefghijklmnopqrstuvwxyz{|}"
+
+
+def feed(n: int, seed: int = 1) -> dict:
+    """Feed con el shape de _fmt_act (polylines de tamaño realista)."""
+    rnd = random.Random(seed)
+    acts = []
+    for i in range(n):
+        uid = f"user{rnd.randrange(50)}"
+        acts.append({
+            "userID":    uid,
+            "id":        str(10_000_000 + i),
+            "type":      rnd.choice(["Run", "Walk"]),
+            "distance":  round(rnd.uniform(1, 25), 2),
+            "duration":  round(rnd.uniform(5, 150), 2),
+            "elevation": round(rnd.uniform(0, 400), 1),
+            "date":      f"2025-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}T07:30:00Z",
+            "includedInLeagues": [f"L{rnd.randrange(5)}"],
+            "likeCount":    rnd.randrange(40),
+            "didILike":     rnd.random() < 0.2,
+            "commentCount": rnd.randrange(10),
+            "avg_speed":    round(rnd.uniform(2, 4), 3),
+            "summary_polyline": "".join(rnd.choice(POLY_CHARS) for _ in range(rnd.randint(300, 1200))),
+        })
+    return {"activities": acts}
+
+
+def bench(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--activities", type=int, default=1000)
+    ap.add_argument("--repeat", type=int, default=20)
+    args = ap.parse_args()
+
+    payload = feed(args.activities)
+    std  = JSONResponse(jsonable_encoder(payload)).body
+    fast = ORJSONResponse(payload).body
+    assert orjson.loads(std) == orjson.loads(fast), "los dos caminos no serializan lo mismo"
+
+    t_std  = bench(lambda: JSONResponse(jsonable_encoder(payload)), args.repeat)
+    t_enc  = bench(lambda: jsonable_encoder(payload), args.repeat)
+    t_fast = bench(lambda: ORJSONResponse(payload), args.repeat)
+    print(f"{args.activities} actividades, {len(fast) / 1024:.0f} KiB")
+    print(f"  jsonable_encoder + json:  {t_std:8.2f} ms  (encoder solo: {t_enc:.2f} ms)")
+    print(f"  ORJSONResponse directo:   {t_fast:8.2f} ms  (x{t_std / t_fast:.1f})")
+
+
+if __name__ == "__main__":
+    main()
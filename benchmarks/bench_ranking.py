@@ -0,0 +1,85 @@
+"""Benchmark y paridad del motor de ranking vectorizado frente a la
+referencia escalar (buckets por usuario + `score`).
+
+    python benchmarks/bench_ranking.py --activities 50000 --users 500
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import ranking  # noqa: E402
+
+
+# valores en los bordes de cada tramo, que las ligas mezclan con aleatorios
+EDGES = [0, 4.99, 5, 5.0000001, 10, 14.99, 15, 60, 61]
+
+
+def league(n_acts: int, n_users: int, seed: int) -> list:
+    """Liga sintética reproducible; también la usan los tests de paridad."""
+    rnd = random.Random(seed)
+    acts = []
+    for _ in range(n_acts):
+        dist = rnd.choice(EDGES) if rnd.random() < 0.1 else round(rnd.uniform(0, 25), 2)
+        dur  = 0 if rnd.random() < 0.02 else round(dist * rnd.choice([5, 7.5, rnd.uniform(3, 10)]), 2)
+        acts.append({"userID":    f"u{rnd.randrange(n_users)}",
+                     "distance":  dist,
+                     "duration":  dur,
+                     "elevation": rnd.choice([0, 10, 99.99, 300, round(rnd.uniform(0, 400), 1)])})
+    return acts
+
+
+def reference(acts: list) -> list:
+    buckets = defaultdict(list)
+    for a in acts:
+        buckets[a["userID"]].append(a)
+    rank = [(uid, ranking.score(ranking.totals(arr))) for uid, arr in buckets.items()]
+    rank.sort(key=lambda x: x[1], reverse=True)
+    return rank
+
+
+def vectorized(acts: list) -> list:
+    return ranking.rank(ranking.aggregate(ranking.from_activities(acts)))
+
+
+def best_of(fn, arg, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--activities", type=int, default=50000)
+    ap.add_argument("--users", type=int, default=500)
+    ap.add_argument("--seeds", type=int, default=20, help="ligas aleatorias para la paridad")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    # paridad: mismos usuarios, mismos puntos y mismo orden
+    for seed in range(args.seeds):
+        acts = league(rnd_size := random.Random(seed).randrange(1, 3000), max(1, rnd_size // 10), seed)
+        assert reference(acts) == vectorized(acts), f"paridad rota con seed={seed}"
+    assert vectorized([]) == reference([]) == []
+    print(f"paridad OK en {args.seeds} ligas aleatorias")
+
+    acts = league(args.activities, args.users, seed=42)
+    assert reference(acts) == vectorized(acts)
+    cols  = ranking.from_activities(acts)
+    t_ref = best_of(reference, acts, args.repeat)
+    t_vec = best_of(vectorized, acts, args.repeat)
+    t_col = best_of(lambda c: ranking.rank(ranking.aggregate(c)), cols, args.repeat)
+    print(f"{args.activities} actividades, {args.users} usuarios")
+    print(f"  escalar:                 {t_ref * 1000:8.2f} ms")
+    print(f"  vectorizado:             {t_vec * 1000:8.2f} ms  (x{t_ref / t_vec:.1f})")
+    print(f"    sin extraer los dicts: {t_col * 1000:8.2f} ms  (x{t_ref / t_col:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Prueba de carga: compara throughput y latencias de dos despliegues del
+backend (p. ej. la versión sync en :10001 y la async en :10000) lanzando
+las mismas peticiones con la misma concurrencia.
+
+    python benchmarks/load_test.py --baseline http://localhost:10001 \\
+        --candidate http://localhost:10000 --path "/league/L1/activities?userID=u1" \\
+        --concurrency 200 --requests 5000
+"""
+import time
+import asyncio
+import argparse
+import statistics
+
+import httpx
+
+
+async def run(base: str, paths: list, concurrency: int, total: int) -> dict:
+    lat, errors = [], 0
+    sem = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=60) as http:
+        async def one(i: int):
+            nonlocal errors
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    r = await http.get(paths[i % len(paths)])
+                    if r.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                lat.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - t0
+
+    q = statistics.quantiles(lat, n=100)
+    return {"rps": total / elapsed, "p50": q[49] * 1000, "p95": q[94] * 1000,
+            "p99": q[98] * 1000, "errors": errors}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--baseline", required=True, help="URL base de la versión de referencia (sync)")
+    ap.add_argument("--candidate", required=True, help="URL base de la versión a comparar (async)")
+    ap.add_argument("--path", action="append", required=True, help="ruta a pedir (repetible)")
+    ap.add_argument("--concurrency", type=int, default=100)
+    ap.add_argument("--requests", type=int, default=2000)
+    args = ap.parse_args()
+
+    print(f"{'':10} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errores':>8}")
+    for name, base in (("baseline", args.baseline), ("candidate", args.candidate)):
+        r = asyncio.run(run(base, args.path, args.concurrency, args.requests))
+        print(f"{name:10} {r['rps']:9.1f} {r['p50']:9.1f} {r['p95']:9.1f} {r['p99']:9.1f} {r['errors']:8d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""Geometría de rutas: polylines codificadas (formato de Google que usa
+Strava en `summary_polyline`) y simplificación Douglas-Peucker para las
+miniaturas de mapa de la app.
+
+`decode` es la referencia escalar; `decode_many` decodifica un lote entero
+de polylines en arrays (n, 2) de NumPy con operaciones sobre todos los
+bytes a la vez, y `route_summaries` saca de cada ruta lo que se guarda en
+la actividad: bounding box, inicio, fin, geohash del inicio y polyline
+simplificada.
+
+Los geohash permiten buscar por cercanía con rangos de prefijo en
+Firestore: `covering_cells` da las celdas que cubren un círculo y
+`haversine_km` hace el filtro exacto sobre los candidatos.
+
+Los heatmaps son rejillas de densidad por tile web-mercator (z/x/y):
+`tile_counts` densifica las rutas y las histograma por tile y celda.
+"""
+import math
+import zlib
+import struct
+
+import numpy as np
+
+PRECISION = 1e5
+
+
+def decode(poly: str) -> list:
+    """Polyline codificada -> [(lat, lng)]."""
+    points, lat, lng, i, n = [], 0, 0, 0, len(poly)
+    while i < n:
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                b = ord(poly[i]) - 63
+                i += 1
+                result |= (b & 0x1F) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / PRECISION, lng / PRECISION))
+    return points
+
+
+def _encode_value(v: int, out: list):
+    v = ~(v << 1) if v < 0 else v << 1
+    while v >= 0x20:
+        out.append(chr((0x20 | (v & 0x1F)) + 63))
+        v >>= 5
+    out.append(chr(v + 63))
+
+
+def encode(points) -> str:
+    """[(lat, lng)] -> polyline codificada."""
+    out, plat, plng = [], 0, 0
+    for lat, lng in points:
+        ilat, ilng = round(lat * PRECISION), round(lng * PRECISION)
+        _encode_value(ilat - plat, out)
+        _encode_value(ilng - plng, out)
+        plat, plng = ilat, ilng
+    return "".join(out)
+
+
+def decode_many(polys: list) -> list:
+    """Lote de polylines -> lista de arrays (n, 2) de [lat, lng].
+
+    Todos los bytes del lote se procesan juntos: cada valor termina en el
+    primer byte < 0x20, sus trozos de 5 bits se suman con `reduceat`, y las
+    coordenadas salen de un `cumsum` de los deltas que se reinicia en el
+    primer punto de cada polyline. ValueError si alguna está mal formada."""
+    out   = [np.empty((0, 2))] * len(polys)
+    items = [(i, p) for i, p in enumerate(polys) if p]
+    if not items:
+        return out
+    raw = np.frombuffer("".join(p for _, p in items).encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    if raw.min() < 0 or raw.max() > 63:
+        raise ValueError("carácter fuera del alfabeto de polyline")
+    lens = np.fromiter((len(p) for _, p in items), dtype=np.int64, count=len(items))
+    last = raw < 0x20                                   # último byte de cada valor
+    if not last[np.cumsum(lens) - 1].all():
+        raise ValueError("polyline truncada")
+
+    starts = np.flatnonzero(np.r_[True, last[:-1]])     # primer byte de cada valor
+    pos    = np.arange(len(raw)) - np.repeat(starts, np.diff(np.r_[starts, len(raw)]))
+    vals   = np.add.reduceat((raw & 0x1F) << (5 * pos), starts)
+    vals   = np.where(vals & 1, ~(vals >> 1), vals >> 1)
+
+    nvals = np.add.reduceat(last, np.r_[0, np.cumsum(lens)[:-1]])
+    if (nvals % 2).any():
+        raise ValueError("número impar de coordenadas")
+    npts   = nvals // 2
+    coords = np.cumsum(vals.reshape(-1, 2), axis=0)
+    ends   = np.cumsum(npts)
+    base   = np.vstack([[0, 0], coords[ends[:-1] - 1]])  # acumulado previo a cada polyline
+    coords = (coords - np.repeat(base, npts, axis=0)) / PRECISION
+    for (i, _), arr in zip(items, np.split(coords, ends[:-1])):
+        out[i] = arr
+    return out
+
+
+def decode_array(poly: str) -> np.ndarray:
+    return decode_many([poly])[0]
+
+
+def simplify_many(routes: list, epsilons) -> list:
+    """Douglas-Peucker de un lote de rutas a la vez. En lugar de una pila por
+    ruta, cada iteración procesa juntos todos los tramos pendientes de todas
+    las rutas (un nivel del árbol de divisiones): distancias al segmento,
+    máximo por tramo con `reduceat` y división de los que superan su
+    tolerancia. Mismo resultado que el recorrido clásico (se parte por el
+    primer punto más lejano); siempre se conservan primer y último punto."""
+    routes = [np.asarray(r, dtype=np.float64).reshape(-1, 2) for r in routes]
+    if not routes:
+        return []
+    sizes = np.fromiter(map(len, routes), dtype=np.int64, count=len(routes))
+    first = np.r_[0, np.cumsum(sizes)[:-1]]
+    pts   = np.concatenate(routes)
+    keep  = np.zeros(len(pts), dtype=bool)
+    keep[first[sizes > 0]] = keep[(first + sizes - 1)[sizes > 0]] = True
+
+    eps2 = np.broadcast_to(np.asarray(epsilons, dtype=np.float64) ** 2, sizes.shape)
+    live = (sizes >= 3) & (eps2 > 0)
+    lo, hi, tol = first[live], (first + sizes - 1)[live], eps2[live]
+    keep[np.flatnonzero(np.repeat(~live, sizes))] = True      # rutas que no se simplifican
+    while len(lo):
+        inner = hi - lo - 1
+        seg   = np.repeat(np.arange(len(lo)), inner)
+        offs  = np.r_[0, np.cumsum(inner)[:-1]]
+        idx   = np.arange(len(seg)) - offs[seg] + lo[seg] + 1
+        a, d  = pts[lo][seg], (pts[hi] - pts[lo])[seg]
+        p     = pts[idx] - a
+        den   = (d * d).sum(axis=1)
+        t     = np.clip(np.divide((p * d).sum(axis=1), den, out=np.zeros_like(den), where=den > 0), 0.0, 1.0)
+        dist  = ((p - t[:, None] * d) ** 2).sum(axis=1)     # al cuadrado, en grados
+
+        worst = np.maximum.reduceat(dist, offs)
+        cand  = np.flatnonzero(dist == worst[seg])
+        first_hit = cand[np.r_[True, seg[cand][1:] != seg[cand][:-1]]]   # primer máximo por tramo
+        split = worst > tol
+        mid   = idx[first_hit][split]
+        keep[mid] = True
+        lo  = np.r_[lo[split], mid]
+        hi  = np.r_[mid, hi[split]]
+        tol = np.r_[tol[split], tol[split]]
+        wide = hi - lo >= 2
+        lo, hi, tol = lo[wide], hi[wide], tol[wide]
+    return [pts[s:s + n][keep[s:s + n]] for s, n in zip(first, sizes)]
+
+
+def simplify(points: np.ndarray, epsilon: float) -> np.ndarray:
+    return simplify_many([points], epsilon)[0]
+
+
+def _tolerance(points: np.ndarray, pixels: int) -> float:
+    """Un píxel sobre el mayor lado del bounding box de la ruta."""
+    return float((points.max(axis=0) - points.min(axis=0)).max()) / pixels
+
+
+def simplify_polyline(poly: str, pixels: int) -> str:
+    """Polyline reducida para una miniatura de `pixels` de lado."""
+    points = decode_array(poly)
+    if len(points) < 3:
+        return poly
+    return encode(simplify(points, _tolerance(points, pixels)))
+
+
+def simplify_polylines(polys: list, pixels: int) -> list:
+    """`simplify_polyline` de un lote con un solo `simplify_many`; las
+    polylines mal formadas quedan en None en lugar de lanzar ValueError."""
+    decoded = decode_lenient(polys)
+    tols = [_tolerance(p, pixels) if len(p) >= 3 else 0.0 for p in decoded]
+    return [None if not len(p) and poly else poly if len(p) < 3 else encode(simp.tolist())
+            for poly, p, simp in zip(polys, decoded, simplify_many(decoded, tols))]
+
+
+# ——— Geohash ————————————————————————————————————————————————
+
+GEOHASH_ALPHABET  = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 9                       # ~5 m: sobra para cualquier radio
+EARTH_RADIUS_KM   = 6371.0088
+
+
+def geohash(lat: float, lng: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_lo, lat_hi, lng_lo, lng_hi = -90.0, 90.0, -180.0, 180.0
+    out, bits, ch, even = [], 0, 0, True
+    while len(out) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            ch = ch << 1 | (lng >= mid)
+            lng_lo, lng_hi = (mid, lng_hi) if lng >= mid else (lng_lo, mid)
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            ch = ch << 1 | (lat >= mid)
+            lat_lo, lat_hi = (mid, lat_hi) if lat >= mid else (lat_lo, mid)
+        even, bits = not even, bits + 1
+        if bits == 5:
+            out.append(GEOHASH_ALPHABET[ch])
+            bits = ch = 0
+    return "".join(out)
+
+
+def _cell_size(precision: int) -> tuple:
+    """(alto, ancho) en grados de una celda de `precision` caracteres."""
+    nbits = 5 * precision
+    return 180.0 / 2 ** (nbits // 2), 360.0 / 2 ** ((nbits + 1) // 2)
+
+
+def covering_cells(lat: float, lng: float, radius_km: float, max_cells: int = 16) -> list:
+    """Prefijos geohash que cubren el bounding box del círculo: la precisión
+    más fina que lo cubre con como mucho `max_cells` celdas, así el coste de
+    la consulta crece con lo que hay cerca y no con el total."""
+    dlat = radius_km / 111.32
+    dlng = min(radius_km / (111.32 * max(math.cos(math.radians(lat)), 1e-6)), 180.0)
+    south, north = max(lat - dlat, -90.0), min(lat + dlat, 90.0 - 1e-9)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        h, w = _cell_size(precision)
+        y0, y1 = math.floor((south + 90) / h), math.floor((north + 90) / h)
+        x0, x1 = math.floor((lng - dlng + 180) / w), math.floor((lng + dlng + 180) / w)
+        if (y1 - y0 + 1) * (x1 - x0 + 1) <= max_cells:
+            break
+    cells = []
+    for y in range(y0, y1 + 1):
+        for x in range(x0, x1 + 1):
+            clng = ((x + 0.5) * w) % 360.0 - 180.0       # centro de la celda, con vuelta en ±180
+            cells.append(geohash((y + 0.5) * h - 90, clng, precision))
+    return list(dict.fromkeys(cells))
+
+
+def haversine_km(lat: float, lng: float, lats, lngs) -> np.ndarray:
+    """Distancia de (lat, lng) a cada punto de los arrays, en km."""
+    lat1, lng1 = math.radians(lat), math.radians(lng)
+    lat2, lng2 = np.radians(np.asarray(lats, dtype=np.float64)), np.radians(np.asarray(lngs, dtype=np.float64))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+# ——— Resumen de ruta ———————————————————————————————————————————
+
+def route_summary(points: np.ndarray, pixels: int, simplified: np.ndarray = None) -> dict:
+    """Campos de ruta que se guardan en la actividad (None sin puntos)."""
+    if not len(points):
+        return None
+    if simplified is None:
+        simplified = simplify(points, _tolerance(points, pixels))
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    return {
+        "start_latlng":        points[0].tolist(),
+        "start_geohash":       geohash(*points[0].tolist()),
+        "end_latlng":          points[-1].tolist(),
+        "bbox":                [*lo.tolist(), *hi.tolist()],    # [minLat, minLng, maxLat, maxLng]
+        "polyline_simplified": encode(simplified.tolist()),
+    }
+
+
+def decode_lenient(polys: list) -> list:
+    """`decode_many`, pero si el lote trae alguna polyline mal formada se
+    decodifican una a una y esas quedan vacías."""
+    try:
+        return decode_many(polys)
+    except ValueError:
+        decoded = []
+        for p in polys:
+            try:
+                decoded.append(decode_array(p))
+            except ValueError:
+                decoded.append(np.empty((0, 2)))
+        return decoded
+
+
+def route_summaries(polys: list, pixels: int) -> list:
+    """`route_summary` de un lote (una tarea de ProcessPoolExecutor); las
+    polylines mal formadas quedan en None."""
+    decoded = decode_lenient(polys)
+    tols = [_tolerance(p, pixels) if len(p) else 0.0 for p in decoded]
+    return [route_summary(p, pixels, simp)
+            for p, simp in zip(decoded, simplify_many(decoded, tols))]
+
+
+# ——— Heatmap: rejillas de densidad por tile ————————————————————————
+
+TILE_SIZE    = 64                 # celdas por lado de cada tile
+MERCATOR_LAT = 85.05112878
+
+
+def _world_px(points: np.ndarray, zoom: int, size: int) -> tuple:
+    """(x, y) web-mercator en celdas del mundo a `zoom` (size celdas por tile)."""
+    scale = size * 2 ** zoom
+    lat = np.radians(np.clip(points[:, 0], -MERCATOR_LAT, MERCATOR_LAT))
+    x = (points[:, 1] + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * scale
+    return np.clip(x, 0, scale - 1e-9), np.clip(y, 0, scale - 1e-9)
+
+
+def _densify(x: np.ndarray, y: np.ndarray, sizes: np.ndarray, max_step: int) -> tuple:
+    """Interpola cada tramo de cada ruta a pasos de como mucho una celda, para
+    que la densidad siga la línea y no solo los vértices. Los saltos de más
+    de `max_step` celdas (GPS perdido) no se rellenan."""
+    starts = np.r_[0, np.cumsum(sizes)[:-1]]
+    seg = np.ones(len(x), dtype=bool)
+    seg[np.cumsum(sizes)[sizes > 0] - 1] = False             # sin tramo tras el último punto
+    i = np.flatnonzero(seg)
+    dx, dy = x[i + 1] - x[i], y[i + 1] - y[i]
+    steps = np.maximum(np.ceil(np.maximum(np.abs(dx), np.abs(dy))), 1).astype(np.int64)
+    steps[steps > max_step] = 1
+    rep = np.repeat(np.arange(len(i)), steps)
+    t = (np.arange(len(rep)) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[rep]
+    last = (starts + sizes - 1)[sizes > 0]
+    return (np.r_[x[i][rep] + t * dx[rep], x[last]],
+            np.r_[y[i][rep] + t * dy[rep], y[last]])
+
+
+def tile_counts(routes: list, zoom: int, size: int = TILE_SIZE) -> dict:
+    """{(x, y) del tile: array (size, size) de cuentas} para `routes`
+    (arrays (n, 2) de lat/lng) a `zoom`; filas = y, columnas = x."""
+    routes = [r for r in routes if len(r)]
+    if not routes:
+        return {}
+    sizes = np.fromiter(map(len, routes), dtype=np.int64, count=len(routes))
+    x, y  = _world_px(np.concatenate(routes), zoom, size)
+    x, y  = _densify(x, y, sizes, 4 * size)
+    tx, ty = (x // size).astype(np.int64), (y // size).astype(np.int64)
+    keys, tile = np.unique(tx * 2 ** zoom + ty, return_inverse=True)
+    cy = np.clip((y - ty * size).astype(np.int64), 0, size - 1)
+    cx = np.clip((x - tx * size).astype(np.int64), 0, size - 1)
+    # un único histograma sobre (tile, celda): filas = y, columnas = x
+    hist = np.bincount(tile.ravel() * size * size + cy * size + cx,
+                       minlength=len(keys) * size * size).reshape(len(keys), size, size)
+    return {(int(k // 2 ** zoom), int(k % 2 ** zoom)): h for k, h in zip(keys, hist)}
+
+
+def heatmap_tiles(routes: list, zooms, size: int = TILE_SIZE, acc: dict = None, sign: int = 1) -> dict:
+    """Suma (o resta, con sign=-1) a `acc` las cuentas de `routes` en todos
+    los `zooms`: {(z, x, y): array (size, size)}."""
+    acc = {} if acc is None else acc
+    for z in zooms:
+        for (x, y), h in tile_counts(routes, z, size).items():
+            acc[(z, x, y)] = acc[(z, x, y)] + sign * h if (z, x, y) in acc else sign * h
+    return acc
+
+
+def encode_tile(counts: np.ndarray) -> bytes:
+    return zlib.compress(np.clip(counts, 0, None).astype("<u4").tobytes(), 6)
+
+
+def decode_tile(blob: bytes, size: int = TILE_SIZE) -> np.ndarray:
+    return np.frombuffer(zlib.decompress(blob), dtype="<u4").reshape(size, size).astype(np.int64)
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def tile_png(counts: np.ndarray, rgb=(252, 76, 2)) -> bytes:
+    """PNG RGBA de un color con la opacidad en escala logarítmica de la
+    densidad, listo para superponer sobre el mapa."""
+    size = counts.shape[0]
+    peak = np.log1p(counts.max()) or 1.0
+    alpha = (np.log1p(counts) / peak * 255).astype(np.uint8)
+    px = np.zeros((size, size, 4), dtype=np.uint8)
+    px[..., :3] = rgb
+    px[..., 3] = alpha
+    raw = np.hstack([np.zeros((size, 1), dtype=np.uint8), px.reshape(size, -1)]).tobytes()
+    return (b"\x89PNG\r\n\x1a\n"
+            + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 6, 0, 0, 0))
+            + _png_chunk(b"IDAT", zlib.compress(raw, 6))
+            + _png_chunk(b"IEND", b""))
@@ -0,0 +1,86 @@
+"""Contabilidad de Firestore y Strava por petición.
+
+`current` lleva el `Usage` de la petición en curso (lo abre el middleware de
+la app); fuera de una petición, en listeners y comandos, no se cuenta nada.
+`MeteredAsyncClient` es un AsyncClient cuyas RPC pasan por
+`_MeteredFirestoreAPI`, que cuenta lecturas, escrituras y queries como las
+factura Firestore.
+
+El proxy se engancha a la propiedad privada `AsyncClient._firestore_api`:
+requirements.txt fija la versión de google-cloud-firestore y
+tests/test_metering.py comprueba que las RPC siguen pasando por él.
+"""
+import contextvars
+
+from google.cloud import firestore
+
+
+class Usage:
+    __slots__ = ("reads", "writes", "queries", "strava")
+
+    def __init__(self):
+        self.reads = self.writes = self.queries = self.strava = 0
+
+    def fields(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+current = contextvars.ContextVar("usage", default=None)
+
+def meter(**counts):
+    u = current.get()
+    if u is not None:
+        for k, n in counts.items():
+            setattr(u, k, getattr(u, k) + n)
+
+async def metered_stream(stream, field: str = None, minimum: int = 0):
+    """Reenvía una RPC en streaming contando una lectura por documento
+    devuelto (`field` presente en la respuesta) y al menos `minimum`."""
+    u, n = current.get(), 0
+    async for r in stream:
+        if field is None or field in r:
+            n += 1
+            if u is not None: u.reads += 1
+        yield r
+    if u is not None and n < minimum:
+        u.reads += minimum - n
+
+class _MeteredFirestoreAPI:
+    """Proxy del cliente GAPIC: todas las RPC del AsyncClient (documentos,
+    queries, batches y transacciones) pasan por aquí. Cuenta como Firestore
+    factura: un doc leído por documento devuelto, una lectura mínima por
+    query o agregación, y una escritura por write del commit."""
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        return getattr(self._api, name)
+
+    async def batch_get_documents(self, *a, **kw):
+        return metered_stream(await self._api.batch_get_documents(*a, **kw), "found")
+
+    async def run_query(self, *a, **kw):
+        meter(queries=1)
+        return metered_stream(await self._api.run_query(*a, **kw), "document", minimum=1)
+
+    async def run_aggregation_query(self, *a, **kw):
+        meter(queries=1, reads=1)
+        return await self._api.run_aggregation_query(*a, **kw)
+
+    async def list_documents(self, *a, **kw):
+        meter(queries=1)
+        return metered_stream(await self._api.list_documents(*a, **kw))
+
+    async def commit(self, *a, request=None, **kw):
+        meter(writes=len(request["writes"] if isinstance(request, dict) else request.writes))
+        return await self._api.commit(*a, request=request, **kw)
+
+class MeteredAsyncClient(firestore.AsyncClient):
+    """AsyncClient cuyas RPC pasan por `_MeteredFirestoreAPI`."""
+
+    @property
+    def _firestore_api(self):
+        api = super()._firestore_api
+        if getattr(self, "_metered_api", None) is None or self._metered_api._api is not api:
+            self._metered_api = _MeteredFirestoreAPI(api)
+        return self._metered_api
@@ -0,0 +1,105 @@
+"""Fechas y periodos de los rankings.
+
+Las fechas se guardan como timestamps UTC (`to_ts`). Cada actividad cae en
+tres buckets —día (d2025-03-14), semana ISO (w2025-W11) y mes (m2025-03)—
+y `range_keys` cubre un rango de días con buckets disjuntos: meses
+completos en el centro y semanas ISO completas y días sueltos en los
+extremos, de modo que un ranking por rango lee pocos documentos.
+
+Sin dependencias de Firestore ni de FastAPI: los errores de entrada son
+ValueError y el endpoint los traduce a 400.
+"""
+from datetime import datetime, timedelta, timezone, date
+
+
+def to_ts(v) -> datetime:
+    """Fecha ISO (con o sin Z) o datetime -> datetime UTC, que Firestore
+    guarda como timestamp nativo y permite filtrar por rango."""
+    if isinstance(v, str):
+        v = datetime.fromisoformat(v.replace("Z", "+00:00"))
+    return v.replace(tzinfo=timezone.utc) if v.tzinfo is None else v.astimezone(timezone.utc)
+
+def as_date(d) -> date:
+    """Día UTC de una fecha ISO o timestamp (un `date` se deja tal cual)."""
+    return to_ts(d).date() if isinstance(d, (str, datetime)) else d
+
+def day_start(d: date) -> datetime:
+    return datetime(d.year, d.month, d.day, tzinfo=timezone.utc)
+
+def next_month(d: date) -> date:
+    return (d.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+# ——— Buckets ——————————————————————————————————————————————————
+
+def bucket_keys(d) -> dict:
+    """{periodo: clave} de los tres buckets a los que pertenece una fecha."""
+    d = as_date(d)
+    y, w, _ = d.isocalendar()
+    return {"day": f"d{d.isoformat()}", "week": f"w{y}-W{w:02d}", "month": f"m{d:%Y-%m}"}
+
+def bucket_span(key: str) -> tuple:
+    """[inicio, fin) de un bucket como timestamps, para acotar consultas."""
+    kind, val = key[0], key[1:]
+    if kind == "d":
+        start = date.fromisoformat(val)
+        end   = start + timedelta(days=1)
+    elif kind == "w":
+        y, w  = val.split("-W")
+        start = datetime.strptime(f"{y}-W{w}-1", "%G-W%V-%u").date()
+        end   = start + timedelta(days=7)
+    else:
+        start = date.fromisoformat(val + "-01")
+        end   = next_month(start)
+    return day_start(start), day_start(end)
+
+def _week_day_keys(start: date, end: date) -> list:
+    keys, d = [], start
+    while d <= end:
+        if d.weekday() == 0 and d + timedelta(days=6) <= end:
+            keys.append(bucket_keys(d)["week"]); d += timedelta(days=7)
+        else:
+            keys.append(bucket_keys(d)["day"]);  d += timedelta(days=1)
+    return keys
+
+def range_keys(start: date, end: date) -> list:
+    """Cubre [start, end] (ambos incluidos) con buckets disjuntos: los meses
+    completos del rango y, en los extremos, semanas ISO completas y días."""
+    first = start if start.day == 1 else next_month(start)
+    m = first
+    while next_month(m) - timedelta(days=1) <= end:
+        m = next_month(m)
+    if m == first:
+        return _week_day_keys(start, end)
+    months, d = [], first
+    while d < m:
+        months.append(bucket_keys(d)["month"]); d = next_month(d)
+    return _week_day_keys(start, first - timedelta(days=1)) + months + _week_day_keys(m, end)
+
+# ——— Periodos de la API ———————————————————————————————————————
+
+def period_range(period: str, date_from: str, date_to: str, today: date = None):
+    """(primer día, último día) pedidos con period/from/to, o None para todo
+    el histórico. `from` tiene prioridad; weekly y monthly son la semana ISO
+    y el mes en curso (UTC). ValueError ante parámetros inválidos."""
+    today = today or datetime.utcnow().date()
+    if date_to and not date_from:
+        raise ValueError("'to' requiere 'from'")
+    if date_from:
+        try:
+            start = date.fromisoformat(date_from)
+            end   = date.fromisoformat(date_to) if date_to else today
+        except ValueError:
+            raise ValueError("Fechas inválidas, formato YYYY-MM-DD")
+        if end < start:
+            raise ValueError("'from' posterior a 'to'")
+        return start, end
+    period = period.lower()
+    if period == "weekly":
+        start = today - timedelta(days=today.weekday())
+        return start, start + timedelta(days=6)
+    if period == "monthly":
+        start = today.replace(day=1)
+        return start, next_month(start) - timedelta(days=1)
+    if period == "general":
+        return None
+    raise ValueError("period debe ser general, weekly o monthly")
@@ -0,0 +1,254 @@
+"""Motor de ranking de ligas.
+
+`score` y `totals` son la referencia escalar (la fórmula original del
+endpoint). El resto carga las actividades, o los standings, en arrays
+columnares de NumPy y calcula los seis componentes de la puntuación con
+reducciones agrupadas por índice de usuario, en una sola pasada.
+
+Las constantes de la puntuación son reglas declarativas (`DEFAULT_RULES`,
+personalizables por liga) que `compile_rules` valida y convierte una sola
+vez en un `ScoringRules` listo para evaluar columnas.
+
+Los agregados (los de `totals`, standings y buckets) suman enteros —metros,
+segundos y decímetros— para que el resultado no dependa del orden en que se
+sumaron las actividades: con floats, 3.8 + 4.6 + 1.6 da 9.999999999999998
+km y 3.8 + 1.6 + 4.6 da 10.0, un punto de diferencia. `apply_activity` los
+mantiene al guardar o re-guardar una actividad sin releer las demás.
+"""
+from typing import NamedTuple
+from operator import itemgetter
+
+import numpy as np
+
+# campo de la actividad (km, minutos, metros) -> campo entero del agregado
+UNITS      = {"distance": ("distance_m", 1000), "duration": ("duration_s", 60),
+              "elevation": ("elevation_dm", 10)}
+SUM_FIELDS = tuple(f for f, _ in UNITS.values())
+AGG_FIELDS = SUM_FIELDS + ("runs", "longest")           # longest: km, es un máximo
+
+# Reglas por defecto: reproducen exactamente `score`
+DEFAULT_RULES = {
+    "version":   0,
+    "distance":  {"cap": 60},                              # 1 punto por km
+    "pace":      {"fast": 5, "slow": 7.5, "points": 60},   # min/km
+    "elevation": {"per_point": 10, "cap": 30},             # metros por punto
+    "runs":      {"per_run": 10, "cap": 30},
+    "long_run":  {"tiers": [{"km": 5, "points": 10},        # Firestore no admite
+                            {"km": 10, "points": 20},       # arrays anidados
+                            {"km": 15, "points": 30}]},
+    "bonus":     {"min_runs": 3, "points": 20},
+}
+
+# ——— Referencia escalar ——————————————————————————————————————
+
+def units(a: dict) -> dict:
+    """Distancia, duración y desnivel de una actividad como enteros."""
+    return {f: round(a[src] * scale) for src, (f, scale) in UNITS.items()}
+
+def totals(arr) -> dict:
+    """Agregados enteros de una lista de actividades (independientes del
+    orden), con la forma de los standings y buckets."""
+    t = {f: 0 for f in SUM_FIELDS}
+    for a in arr:
+        for f, v in units(a).items():
+            t[f] += v
+    t["runs"]    = len(arr)
+    t["longest"] = max((a["distance"] for a in arr), default=0)
+    return t
+
+def score(t: dict) -> int:
+    pts = 0
+    # 1) distancia
+    dist = t["distance_m"] / 1000
+    pts += min(60, int(dist))
+    # 2) ritmo
+    time_m = t["duration_s"] / 60
+    spkph  = dist/(time_m/60) if time_m > 0 else 0
+    pace   = (1/spkph)*60 if spkph > 0 else float('inf')
+    if pace <= 5:      pts += 60
+    elif pace >= 7.5:  pts += 0
+    else:              pts += round((7.5 - pace)/(7.5 - 5)*60)
+    # 3) desnivel
+    elev = t["elevation_dm"] / 10
+    pts += min(30, int(elev/10))
+    # 4) carreras
+    runs = t["runs"]
+    pts += min(30, runs*10)
+    # 5) tirada larga
+    longest = t["longest"]
+    if   longest >= 15: pts += 30
+    elif longest >= 10: pts += 20
+    elif longest >= 5:  pts += 10
+    # 6) bonus
+    if runs >= 3:      pts += 20
+    return pts
+
+# ——— Agregados incrementales —————————————————————————————————
+
+def apply_activity(agg: dict, old: dict = None, new: dict = None) -> bool:
+    """Resta de `agg` la versión previa de una actividad (si la había) y suma
+    la nueva (si la hay), como al re-guardarla. Devuelve True si la tirada más
+    larga se ha acortado: entonces `longest` hay que recalcularlo con el resto
+    de actividades del usuario, que aquí no se conocen."""
+    if old is not None:
+        for f, v in units(old).items():
+            agg[f] -= v
+        agg["runs"] -= 1
+    if new is not None:
+        for f, v in units(new).items():
+            agg[f] += v
+        agg["runs"] += 1
+
+    new_dist = new["distance"] if new is not None else 0
+    if old is not None and old["distance"] >= agg["longest"] > new_dist:
+        return True
+    agg["longest"] = max(agg["longest"], new_dist)
+    return False
+
+# ——— Motor columnar ——————————————————————————————————————————
+
+class Columns(NamedTuple):
+    """Una fila por actividad (o por usuario, tras `aggregate`); `idx` es el
+    índice de cada fila en `users`. Distancia, duración y desnivel van en
+    las unidades enteras de los agregados (int64)."""
+    users:     list
+    idx:       np.ndarray
+    distance:  np.ndarray
+    duration:  np.ndarray
+    elevation: np.ndarray
+    runs:      np.ndarray
+    longest:   np.ndarray
+
+def _encode(uids: list) -> tuple:
+    """(usuarios únicos en orden de primera aparición, índice por fila)."""
+    codes = dict.fromkeys(uids)
+    for i, u in enumerate(codes):
+        codes[u] = i
+    return list(codes), np.fromiter(map(codes.__getitem__, uids), dtype=np.intp, count=len(uids))
+
+_act_values = itemgetter(*UNITS)
+_scales     = np.array([scale for _, scale in UNITS.values()], dtype=np.float64)
+
+def from_activities(acts) -> Columns:
+    """Actividades (dicts con userID/distance/duration/elevation) a columnas;
+    cada fila cuenta como una carrera cuya tirada más larga es ella misma."""
+    users, idx = _encode(list(map(itemgetter("userID"), acts)))
+    vals = np.array(list(map(_act_values, acts)), dtype=np.float64).reshape(-1, 3)
+    ints = np.round(vals * _scales).astype(np.int64)        # mismo redondeo que `units`
+    return Columns(users, idx, ints[:, 0], ints[:, 1], ints[:, 2],
+                   np.ones(len(idx), dtype=np.int64), vals[:, 0])
+
+def from_totals(rows: dict) -> Columns:
+    """{uid: agregados} (standings) a columnas, una fila por uid."""
+    users = list(rows)
+    return _agg_columns(users, np.arange(len(users)), [rows[u] for u in users])
+
+def from_buckets(rows: list) -> Columns:
+    """Buckets (dicts con userID y agregados) a columnas, una fila por
+    bucket; `aggregate` las suma por usuario."""
+    users, idx = _encode([r["userID"] for r in rows])
+    return _agg_columns(users, idx, rows)
+
+def _agg_columns(users: list, idx: np.ndarray, rows: list) -> Columns:
+    ints = np.array([[r[f] for f in SUM_FIELDS + ("runs",)] for r in rows],
+                    dtype=np.int64).reshape(-1, len(SUM_FIELDS) + 1)
+    longest = np.array([r["longest"] for r in rows], dtype=np.float64)
+    return Columns(users, idx, ints[:, 0], ints[:, 1], ints[:, 2], ints[:, 3], longest)
+
+def aggregate(cols: Columns) -> Columns:
+    """Reduce las filas a una por usuario en una pasada: sumas con
+    `bincount` (enteros, exactos en float64 hasta 2**53) y máximo con
+    `maximum.at`."""
+    n, idx = len(cols.users), cols.idx
+    longest = np.zeros(n)
+    np.maximum.at(longest, idx, cols.longest)
+    return Columns(cols.users, np.arange(n),
+                   *(np.bincount(idx, weights=c, minlength=n).astype(np.int64)
+                     for c in (cols.distance, cols.duration, cols.elevation, cols.runs)),
+                   longest)
+
+# ——— Reglas de puntuación ————————————————————————————————————
+
+def merge_rules(spec: dict = None) -> dict:
+    """`DEFAULT_RULES` con los parámetros de `spec` encima, sección a sección.
+    ValueError ante reglas o parámetros desconocidos."""
+    r = {k: (dict(v) if isinstance(v, dict) else v) for k, v in DEFAULT_RULES.items()}
+    for k, v in (spec or {}).items():
+        if k not in r:
+            raise ValueError(f"regla desconocida: {k}")
+        if isinstance(r[k], dict):
+            if not isinstance(v, dict) or set(v) - set(r[k]):
+                raise ValueError(f"parámetros inválidos en {k}: {v}")
+            r[k].update(v)
+        else:
+            r[k] = v
+    return r
+
+class ScoringRules:
+    """Reglas de puntuación compiladas: validadas y convertidas a constantes
+    y arrays una sola vez, de modo que evaluar un ranking no vuelve a
+    interpretar la configuración de la liga."""
+
+    __slots__ = ("version", "dist_cap", "fast", "slow", "pace_pts",
+                 "elev_per", "elev_cap", "per_run", "runs_cap",
+                 "tier_km", "tier_pts", "bonus_runs", "bonus_pts")
+
+    def __init__(self, spec: dict = None):
+        r = merge_rules(spec)
+        try:
+            self.version    = int(r["version"])
+            self.dist_cap   = float(r["distance"]["cap"])
+            self.fast       = float(r["pace"]["fast"])
+            self.slow       = float(r["pace"]["slow"])
+            self.pace_pts   = float(r["pace"]["points"])
+            self.elev_per   = float(r["elevation"]["per_point"])
+            self.elev_cap   = float(r["elevation"]["cap"])
+            self.per_run    = float(r["runs"]["per_run"])
+            self.runs_cap   = float(r["runs"]["cap"])
+            tiers           = sorted((float(t["km"]), float(t["points"])) for t in r["long_run"]["tiers"])
+            self.bonus_runs = int(r["bonus"]["min_runs"])
+            self.bonus_pts  = float(r["bonus"]["points"])
+        except (TypeError, ValueError, KeyError) as e:
+            raise ValueError(f"reglas inválidas: {e}") from e
+        if not self.fast < self.slow:
+            raise ValueError("pace.fast debe ser menor que pace.slow")
+        if self.elev_per <= 0:
+            raise ValueError("elevation.per_point debe ser positivo")
+
+        # tramos de tirada larga: searchsorted sobre los km mínimos
+        self.tier_km  = np.array([km for km, _ in tiers])
+        self.tier_pts = np.array([0.0] + [p for _, p in tiers])
+
+    def score(self, cols: Columns) -> np.ndarray:
+        """Puntos por fila sobre filas ya agregadas por usuario."""
+        dist, time_m, runs = cols.distance / 1000, cols.duration / 60, cols.runs
+        with np.errstate(divide="ignore", invalid="ignore"):
+            spkph = np.where(time_m > 0, dist / (time_m / 60), 0.0)
+            pace  = np.where(spkph > 0, (1 / spkph) * 60, np.inf)
+            pace_pts = np.where(pace <= self.fast, self.pace_pts,
+                       np.where(pace >= self.slow, 0.0,
+                                np.round((self.slow - pace) / (self.slow - self.fast) * self.pace_pts)))
+
+        pts  = np.minimum(self.dist_cap, np.trunc(dist))
+        pts += pace_pts
+        pts += np.minimum(self.elev_cap, np.trunc(cols.elevation / 10 / self.elev_per))
+        pts += np.minimum(self.runs_cap, runs * self.per_run)
+        pts += self.tier_pts[np.searchsorted(self.tier_km, cols.longest, side="right")]
+        pts += np.where(runs >= self.bonus_runs, self.bonus_pts, 0.0)
+        return pts.astype(np.int64)
+
+def compile_rules(spec: dict = None) -> ScoringRules:
+    return ScoringRules(spec)
+
+DEFAULT = compile_rules()
+
+def score_columns(cols: Columns, rules: ScoringRules = DEFAULT) -> np.ndarray:
+    """Vectorización exacta de `score` (con las reglas por defecto)."""
+    return rules.score(cols)
+
+def rank(agg: Columns, rules: ScoringRules = DEFAULT) -> list:
+    """[(uid, puntos)] de mayor a menor sobre filas ya agregadas por usuario;
+    los empates conservan el orden de las filas. Usuarios sin carreras fuera."""
+    pts   = rules.score(agg)
+    order = np.argsort(-pts, kind="stable")
+    return [(agg.users[i], int(pts[i])) for i in order if agg.runs[i] > 0]
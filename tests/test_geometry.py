@@ -0,0 +1,24 @@
+"""Simplificación de polylines por lotes frente a la de una en una.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import geometry  # noqa: E402
+
+
+def test_simplify_polylines_matches_simplify_polyline():
+    rnd = random.Random(0)
+    polys = [geometry.encode([(40 + rnd.random(), -3 + rnd.random()) for _ in range(rnd.randrange(1, 300))])
+             for _ in range(50)]
+    assert geometry.simplify_polylines(polys, 200) == [geometry.simplify_polyline(p, 200) for p in polys]
+
+
+def test_simplify_polylines_skips_malformed():
+    good = geometry.encode([(40.0, -3.0), (40.1, -3.2), (40.3, -3.1), (40.4, -3.3)])
+    out = geometry.simplify_polylines(["abc", good, "", "@@@"], 200)
+    assert out == [None, geometry.simplify_polyline(good, 200), "", None]
+    assert geometry.simplify_polylines([], 200) == []
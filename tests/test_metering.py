@@ -0,0 +1,84 @@
+"""El proxy de `metering` sigue en el camino de las RPC del AsyncClient:
+depende de la propiedad privada `_firestore_api`, así que una versión de
+google-cloud-firestore que la cambie tiene que romper aquí y no dejar de
+contar en silencio.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import asyncio
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud.firestore_v1.types import (BatchGetDocumentsResponse, CommitResponse, Document,
+                                             RunAggregationQueryResponse, RunQueryResponse, WriteResult)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import metering  # noqa: E402
+
+ROOT = "projects/test/databases/(default)/documents"
+
+
+async def _stream(items):
+    for r in items:
+        yield r
+
+
+class FakeGapic:
+    """Respuestas fijas en lugar del servidor; anota las RPC que le llegan."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def batch_get_documents(self, request=None, **kw):
+        self.calls.append("batch_get_documents")
+        return _stream([BatchGetDocumentsResponse(found=Document(name=name)) for name in request["documents"]])
+
+    async def run_query(self, request=None, **kw):
+        self.calls.append("run_query")
+        return _stream([RunQueryResponse(document=Document(name=f"{ROOT}/users/u{i}")) for i in range(3)])
+
+    async def run_aggregation_query(self, request=None, **kw):
+        self.calls.append("run_aggregation_query")
+        return _stream([RunAggregationQueryResponse()])
+
+    async def commit(self, request=None, **kw):
+        self.calls.append("commit")
+        return CommitResponse(write_results=[WriteResult() for _ in request["writes"]])
+
+
+def test_rpcs_go_through_the_proxy():
+    async def run():
+        db = metering.MeteredAsyncClient(project="test", credentials=AnonymousCredentials())
+        assert isinstance(db._firestore_api, metering._MeteredFirestoreAPI)
+        fake = FakeGapic()
+        db._firestore_api_internal = fake           # el proxy se rehace sobre el GAPIC nuevo
+
+        usage = metering.Usage()
+        token = metering.current.set(usage)
+        try:
+            snaps = [s async for s in db.get_all([db.document("users/a"), db.document("users/b")])]
+            docs  = [d async for d in db.collection("users").stream()]
+            await db.collection("users").count().get()
+            batch = db.batch()
+            batch.set(db.document("users/a"), {"x": 1})
+            batch.set(db.document("users/b"), {"x": 2})
+            await batch.commit()
+        finally:
+            metering.current.reset(token)
+        return fake.calls, usage, len(snaps), len(docs)
+
+    calls, usage, n_snaps, n_docs = asyncio.run(run())
+    assert calls == ["batch_get_documents", "run_query", "run_aggregation_query", "commit"]
+    assert (n_snaps, n_docs) == (2, 3)
+    assert usage.fields() == {"reads": 2 + 3 + 1, "writes": 2, "queries": 2, "strava": 0}
+
+
+def test_nothing_is_counted_outside_a_request():
+    async def run():
+        db = metering.MeteredAsyncClient(project="test", credentials=AnonymousCredentials())
+        db._firestore_api_internal = FakeGapic()
+        return [s async for s in db.get_all([db.document("users/a")])]
+
+    assert len(asyncio.run(run())) == 1
+    assert metering.current.get() is None
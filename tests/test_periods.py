@@ -0,0 +1,76 @@
+"""Buckets y rangos: claves coherentes con sus intervalos y cobertura
+disjunta y completa de cualquier rango de días.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import random
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import periods  # noqa: E402
+
+DAY = timedelta(days=1)
+
+
+def span_days(key: str) -> list:
+    start, end = periods.bucket_span(key)
+    return [(start + DAY * i).date() for i in range((end - start).days)]
+
+
+def test_range_keys_cover_range_exactly():
+    rnd = random.Random(0)
+    base = date(2019, 12, 1)
+    for _ in range(3000):
+        start = base + DAY * rnd.randrange(2000)
+        end   = start + DAY * rnd.choice([0, 1, 6, 7, 13, rnd.randrange(40), rnd.randrange(800)])
+        days  = [d for key in periods.range_keys(start, end) for d in span_days(key)]
+        assert len(days) == len(set(days)), (start, end)                   # disjuntos
+        assert sorted(days) == [start + DAY * i for i in range((end - start).days + 1)], (start, end)
+
+
+def test_range_keys_use_coarse_buckets():
+    assert periods.range_keys(date(2025, 3, 1), date(2025, 5, 31)) == ["m2025-03", "m2025-04", "m2025-05"]
+    assert periods.range_keys(date(2025, 3, 10), date(2025, 3, 16)) == ["w2025-W11"]
+    assert periods.range_keys(date(2025, 3, 14), date(2025, 3, 14)) == ["d2025-03-14"]
+    assert periods.range_keys(date(2025, 2, 28), date(2025, 4, 1)) == ["d2025-02-28", "m2025-03", "d2025-04-01"]
+
+
+def test_bucket_keys_match_spans():
+    d = date(2018, 12, 20)
+    for _ in range(1200):                                   # cruza cambios de año ISO
+        for key in periods.bucket_keys(d).values():
+            start, end = periods.bucket_span(key)
+            assert start <= periods.day_start(d) < end, (d, key)
+        d += DAY
+
+
+def test_bucket_keys_accept_timestamps():
+    keys = {"day": "d2025-01-01", "week": "w2025-W01", "month": "m2025-01"}
+    assert periods.bucket_keys(date(2025, 1, 1)) == keys
+    assert periods.bucket_keys("2025-01-01T23:30:00Z") == keys
+    assert periods.bucket_keys("2025-01-02T00:30:00+02:00") == keys
+    assert periods.bucket_keys(datetime(2025, 1, 1, 12, tzinfo=timezone.utc)) == keys
+    assert periods.bucket_keys(date(2024, 12, 30))["week"] == "w2025-W01"
+
+
+def test_period_range():
+    today = date(2025, 3, 14)                               # viernes
+    assert periods.period_range("general", None, None, today) is None
+    assert periods.period_range("weekly", None, None, today) == (date(2025, 3, 10), date(2025, 3, 16))
+    assert periods.period_range("MONTHLY", None, None, today) == (date(2025, 3, 1), date(2025, 3, 31))
+    assert periods.period_range("monthly", None, None, date(2024, 2, 29)) == (date(2024, 2, 1), date(2024, 2, 29))
+    assert periods.period_range("weekly", "2025-01-05", None, today) == (date(2025, 1, 5), today)
+    assert periods.period_range("general", "2025-01-05", "2025-01-05", today) == (date(2025, 1, 5),) * 2
+
+
+@pytest.mark.parametrize("period,date_from,date_to", [("general", None, "2025-01-01"),
+                                                      ("general", "2025-13-01", None),
+                                                      ("general", "2025-01-02", "2025-01-01"),
+                                                      ("yearly", None, None)])
+def test_period_range_errors(period, date_from, date_to):
+    with pytest.raises(ValueError):
+        periods.period_range(period, date_from, date_to, date(2025, 3, 14))
@@ -0,0 +1,183 @@
+"""Paridad del motor columnar con la referencia escalar (`score(totals)`),
+sobre ligas aleatorias y valores en los bordes de cada tramo.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import random
+from collections import defaultdict
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+import ranking  # noqa: E402
+# las ligas salen del mismo generador que el benchmark
+from bench_ranking import EDGES, league  # noqa: E402
+
+
+def by_user(acts: list) -> dict:
+    out = defaultdict(list)
+    for a in acts:
+        out[a["userID"]].append(a)
+    return out
+
+
+def reference(acts: list, score=ranking.score) -> list:
+    rank = [(uid, score(ranking.totals(arr))) for uid, arr in by_user(acts).items()]
+    rank.sort(key=lambda x: x[1], reverse=True)
+    return rank
+
+
+def boundary_league() -> list:
+    """Un usuario por combinación de distancia y ritmo en el borde de cada tramo."""
+    acts = []
+    for i, dist in enumerate(EDGES):
+        for j, pace in enumerate([0, 4.99, 5, 6.25, 7.5, 7.51]):
+            for k in range(1 + (i + j) % 4):            # 1..4 carreras: bonus a partir de 3
+                acts.append({"userID": f"b{i}-{j}", "distance": dist,
+                             "duration": round(dist * pace, 2), "elevation": EDGES[k] * 10})
+    return acts
+
+
+LEAGUES = [league(random.Random(s).randrange(1, 3000), 1 + s * 7, s) for s in range(20)]
+LEAGUES.append(boundary_league())
+
+
+@pytest.mark.parametrize("acts", LEAGUES)
+def test_rank_matches_scalar_reference(acts):
+    assert ranking.rank(ranking.aggregate(ranking.from_activities(acts))) == reference(acts)
+
+
+@pytest.mark.parametrize("acts", LEAGUES)
+def test_from_totals_matches_from_activities(acts):
+    rows = {uid: ranking.totals(arr) for uid, arr in by_user(acts).items()}
+    assert ranking.rank(ranking.from_totals(rows)) == reference(acts)
+    buckets = [{"userID": a["userID"], **ranking.totals([a])} for a in acts]
+    assert ranking.rank(ranking.aggregate(ranking.from_buckets(buckets))) == reference(acts)
+
+
+def test_totals_do_not_depend_on_order():
+    arr = [{"distance": d, "duration": 40, "elevation": 0} for d in (3.8, 4.6, 1.6)]
+    assert ranking.totals(arr) == ranking.totals(arr[::-1])
+    assert ranking.totals(arr)["distance_m"] == 10000
+
+
+def test_empty_league():
+    assert ranking.rank(ranking.aggregate(ranking.from_activities([]))) == []
+    assert ranking.rank(ranking.from_totals({})) == []
+
+
+# ——— Agregados incrementales ——————————————————————————————————
+
+def replay(saves: list) -> tuple:
+    """Aplica (id, bucket, actividad) como los guardados de `_save_fanout_tx`:
+    un standing y un agregado por bucket, mantenidos con `apply_activity` y
+    recalculando `longest` con el resto de copias cuando se acorta."""
+    copies, standing, buckets = {}, None, {}
+
+    def longest(key=None):
+        return max([0] + [a["distance"] for k, a in copies.values() if key in (None, k)])
+
+    for act_id, key, new in saves:
+        old_key, old = copies.pop(act_id, (None, None))
+        if standing is None:
+            standing = ranking.totals([a for _, a in copies.values()])
+        if ranking.apply_activity(standing, old, new):
+            standing["longest"] = max(new["distance"], longest())
+        for k in dict.fromkeys(k for k in (old_key, key) if k is not None):
+            agg = buckets.pop(k, None) or ranking.totals([])
+            moved_in = new if k == key else None
+            if ranking.apply_activity(agg, old if k == old_key else None, moved_in):
+                agg["longest"] = max(moved_in["distance"] if moved_in else 0, longest(k))
+            if agg["runs"]:
+                buckets[k] = agg
+        copies[act_id] = (key, new)
+    return copies, standing, buckets
+
+
+def random_saves(seed: int, n: int = 300) -> list:
+    rnd = random.Random(seed)
+    dists = [0, 1.6, 3.8, 4.6, 5, 9.99, 10, 12.3, 15, 21.1]
+    saves = []
+    for _ in range(n):
+        dist = rnd.choice(dists) if rnd.random() < 0.7 else round(rnd.uniform(0, 25), 2)
+        saves.append((rnd.randrange(12), rnd.choice("abcd"),           # re-guardados y cambios de bucket
+                      {"distance": dist, "duration": round(dist * rnd.uniform(3, 9), 2),
+                       "elevation": rnd.choice([0, 9.99, 10, 0.1, round(rnd.uniform(0, 300), 1)])}))
+    return saves
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_incremental_aggregates_match_totals(seed):
+    saves = random_saves(seed)
+    for n in (1, 7, 50, len(saves)):
+        copies, standing, buckets = replay(saves[:n])
+        acts = [a for _, a in copies.values()]
+        assert standing == ranking.totals(acts)
+        assert ranking.score(standing) == ranking.score(ranking.totals(acts))
+        assert buckets == {k: ranking.totals([a for b, a in copies.values() if b == k])
+                           for k in {b for b, _ in copies.values()}}
+
+
+def test_longest_run_shrinks():
+    long, short = ({"distance": d, "duration": d * 6, "elevation": 0} for d in (15, 4))
+    copies, standing, buckets = replay([(1, "a", long), (2, "a", dict(short, distance=8)),
+                                        (1, "a", short)])
+    assert standing["longest"] == buckets["a"]["longest"] == 8
+    copies, standing, buckets = replay([(1, "a", long), (1, "b", short)])       # cambia de bucket
+    assert standing["longest"] == 4 and buckets == {"b": ranking.totals([short])}
+
+
+# ——— Reglas ——————————————————————————————————————————————————
+
+def rules_score(t: dict, spec: dict = None) -> int:
+    """`score` escrito a mano sobre `merge_rules(spec)`, para las reglas
+    personalizadas."""
+    r = ranking.merge_rules(spec)
+    dist, time_m, runs = t["distance_m"] / 1000, t["duration_s"] / 60, t["runs"]
+    pts = min(r["distance"]["cap"], int(dist))
+    pace = 60 / (dist / (time_m / 60)) if time_m > 0 and dist > 0 else float("inf")
+    fast, slow, pace_pts = r["pace"]["fast"], r["pace"]["slow"], r["pace"]["points"]
+    if pace <= fast:   pts += pace_pts
+    elif pace < slow:  pts += round((slow - pace) / (slow - fast) * pace_pts)
+    pts += min(r["elevation"]["cap"], int(t["elevation_dm"] / 10 / r["elevation"]["per_point"]))
+    pts += min(r["runs"]["cap"], runs * r["runs"]["per_run"])
+    pts += max([tier["points"] for tier in r["long_run"]["tiers"] if t["longest"] >= tier["km"]], default=0)
+    if runs >= r["bonus"]["min_runs"]:
+        pts += r["bonus"]["points"]
+    return int(pts)
+
+
+CUSTOM = {"distance":  {"cap": 100},
+          "pace":      {"fast": 4, "slow": 8, "points": 40},
+          "elevation": {"per_point": 5},
+          "runs":      {"per_run": 5, "cap": 50},
+          "long_run":  {"tiers": [{"km": 21.1, "points": 50}, {"km": 10, "points": 15}]},
+          "bonus":     {"min_runs": 5, "points": 35}}
+
+
+@pytest.mark.parametrize("acts", LEAGUES[:5] + LEAGUES[-1:])
+def test_default_rules_match_score(acts):
+    rules = ranking.compile_rules()
+    assert ranking.rank(ranking.aggregate(ranking.from_activities(acts)), rules) == reference(acts)
+    assert reference(acts, rules_score) == reference(acts)
+
+
+@pytest.mark.parametrize("acts", LEAGUES[:5] + LEAGUES[-1:])
+def test_custom_rules(acts):
+    rules = ranking.compile_rules(CUSTOM)
+    got = ranking.rank(ranking.aggregate(ranking.from_activities(acts)), rules)
+    assert got == reference(acts, lambda t: rules_score(t, CUSTOM))
+
+
+@pytest.mark.parametrize("spec", [{"nope": {}},
+                                  {"pace": {"fast": 8, "slow": 5}},
+                                  {"pace": {"tempo": 1}},
+                                  {"elevation": {"per_point": 0}},
+                                  {"long_run": {"tiers": [{"km": "x", "points": 1}]}},
+                                  {"bonus": 3}])
+def test_invalid_rules(spec):
+    with pytest.raises(ValueError):
+        ranking.compile_rules(spec)